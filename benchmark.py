@@ -0,0 +1,400 @@
+import os
+import sys
+import json
+import math
+import time
+import random
+import argparse
+import platform
+import statistics
+import subprocess
+import tempfile
+from datetime import datetime, timedelta
+import pandas as pd
+import fare_filing_script as ffs
+
+# Benchmark for fare_filing_script: generates a synthetic data.xlsx and input.xlsx,
+# runs the filing on them and times each stage separately.
+#
+#   python benchmark.py --atpco 10000 100000 --rows 2000 --repeat 3 --json bench.json
+#   python benchmark.py --atpco 10000 --compare bench.json
+#
+# Stages: load (data.xlsx and input.xlsx), validate, price (enrich and price every row),
+# write (fill the output sheets), save (output workbook and status write-back).
+# Start-up is reported too: time until the script's first output and its import times.
+
+LEVELS = list("LQHKUBRNMTWOEIAY")
+BRANDS = ['Brand 1', 'Brand 2', 'Brand 3', 'GDS 1', 'GDS 2']
+FNS = ['PX', 'QX']
+ORIGINS = ['BAH', 'KWI', 'DOH', 'MCT', 'SLL', 'RUH', 'JED']
+CURRENCY = {'BAH': 'BHD', 'KWI': 'KWD', 'DOH': 'QAR', 'MCT': 'OMR', 'SLL': 'OMR', 'RUH': 'SAR', 'JED': 'SAR'}
+RATES = {'BHD': 9.74, 'KWD': 11.95, 'QAR': 1.0087, 'SAR': 0.979, 'OMR': 9.54}
+DESTINATIONS = ['GYD', 'TBS', 'SAW', 'DXB', 'OTP', 'CAI', 'AMM', 'BEY', 'LHR', 'VKO', 'ESB', 'IKA']
+# Destination listed on Fare Calc OD with no ATPCO fares, for the 'Missing ATPCO data' path
+NO_ATPCO_DEST = 'KTM'
+RESTRICTED = [('RUH', 'BEY'), ('JED', 'AMM')]
+# One OD in this many has a blank FN on its structure RBD rows
+BLANK_FN_EVERY = 5
+
+# Edge cases the random rows practically never reach, filed on an OD of their own (made-up
+# destinations, fixed values): origin, destination, trip, input RBD level, fare level of
+# the B1, and the B1 base fare less the ATPCO Brand 1 base fare at that fare level.
+# The edge ODs' tax and YQ are exact in binary, so that difference is exact too.
+EDGE_CASES = {
+    # AMEND whose Brand 1 fare rounds onto the filed one: filed 1 higher
+    'amend same fare': ('BAH', 'EGA', 1, 5, 5, -0.5),
+    # AMEND of exactly the filed fare: '//Not amended as same fare'
+    'not amended': ('KWI', 'EGB', 2, 5, 5, 0),
+    # Walk up to a level whose Brand 1 fare is within 1: +10 in QAR and SAR, +1 otherwise.
+    # The levels deleted on the way have whitespace-padded keys, and these ODs have a
+    # second row for every deleted and GH key (lookups take the first)
+    'bump QAR': ('DOH', 'EGC', 1, 3, 5, -1),
+    'bump other': ('BAH', 'EGD', 2, 3, 5, 0.5),
+    # Tfee discount row with blank OW and RT: 'Missing TFEE data in Fare Calc OD sheet'
+    'missing tfee': ('KWI', 'EGE', 1, 4, 4, 0.25),
+}
+EDGE_TAX = (12.25, 5.5, 2.0)
+
+# Share of input rows per path. new: filed above the fare's RBD (builds down to it),
+# amend: filed at it, delete: filed below it (deletes up to it), reject: fails a check
+INPUT_MIX = {'new': 0.3, 'amend': 0.25, 'delete': 0.25, 'reject': 0.2}
+REJECTS = ['missing data', 'bad B1', 'restricted OD', 'bad origin', 'bad destination',
+           'bad trip', 'bad RBD', 'bad currency', 'missing ATPCO', 'low fare']
+
+# ATPCO rows per OD: both trips, every level and brand plus the GH fares of Brands 1-3, per FN
+ROWS_PER_OD = 2 * (len(LEVELS) * len(BRANDS) + 3) * len(FNS)
+
+#Destination codes: the usual ones, then made-up codes until there are enough
+def destinations(count):
+    codes = list(DESTINATIONS)
+    letters = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+    for a in letters:
+        for b in letters:
+            if len(codes) >= count:
+                return codes[:count]
+            codes.append('Z' + a + b)
+    return codes[:count]
+
+#Tax rows for every OD and journey type: {(origin, dest, 'OW'/'RT'): (FixedTaxTotal, YQ, YR)}
+def make_taxes(rnd, ods):
+    taxes = {}
+    for o, d in ods:
+        for journey in ('OW', 'RT'):
+            taxes[(o, d, journey)] = (round(rnd.uniform(3, 40), 3), rnd.choice([0, 5.5, 12, 20.25]),
+                                      rnd.choice([1, 2.5, 3, 7]))
+    return taxes
+
+#ATPCO Brand 1 base fare at an edge case's fare level, and the case's input B1. The base
+#fare with YQ is put mid-band in the fare ladder so the B1 files at that level.
+def edge_fares(origin, trip, level, offset):
+    low, high = next((low, high) for t, r, low, high, _ in ffs.DEFAULT_FARE_LADDER
+                     if t == trip and r == LEVELS[level - 1])
+    tax, yq, _ = EDGE_TAX
+    filed = round((low + high) / 2 / RATES[CURRENCY[origin]] - yq)
+    return filed, filed + offset + yq + tax
+
+#ATPCO rows of the EDGE_CASES ODs: every level, brand and FN of the case's trip, with
+#fixed fares except the case's Brand 1 fare at its fare level
+def edge_atpco_rows(start):
+    rows = []
+    for origin, dest, trip, filed, level, offset in EDGE_CASES.values():
+        loc1, loc2 = ffs.CODE_MAP.get(origin, origin), ffs.CODE_MAP.get(dest, dest)
+        case_fare, _ = edge_fares(origin, trip, level, offset)
+        deleted = range(filed, level) if filed < level else range(0)
+        repeats = []
+        for number, rbd in enumerate(LEVELS + ['GH'], 1):
+            for b, brand in enumerate(BRANDS if rbd != 'GH' else BRANDS[:3]):
+                for fn in FNS:
+                    base = case_fare if (number, brand) == (level, 'Brand 1') else 100 + 40 * number + 10 * b
+                    row = ['IPRMEA', 'G9', 'KW', 'AZ', loc1, loc2, 'R1', f'{dest}{rbd}{trip}{brand[-1]}-{fn}',
+                           trip, number, fn, CURRENCY[origin], base, start, 'INF', 5000 + number,
+                           rbd, brand, (20, 30, 40, 50, 30)[b], base, base + 30]
+                    if number in deleted or (rbd == 'GH' and deleted):
+                        repeat = list(row)
+                        repeat[7] += 'X'
+                        repeat[12] += 7
+                        repeat[18] += 10
+                        repeats.append(repeat)
+                    if number in deleted:
+                        for col in (4, 5, 10, 16, 17):
+                            row[col] = f' {row[col]} '
+                    rows.append(tuple(row))
+        rows.extend(tuple(row) for row in repeats)
+    return rows
+
+#Write a data.xlsx with the seven sheets read_data reads and about atpco_rows ATPCO rows.
+#Returns the ODs and taxes the input generator needs.
+def make_data(path, atpco_rows, seed=1):
+    rnd = random.Random(seed)
+    dests = destinations(max(1, math.ceil(atpco_rows / ROWS_PER_OD / len(ORIGINS))))
+    ods = [(o, d) for o in ORIGINS for d in dests]
+    taxes = make_taxes(rnd, ods + [(o, NO_ATPCO_DEST) for o in ORIGINS])
+    start = datetime(2025, 1, 1)
+    rows = []
+    for i, (o, d) in enumerate(ods):
+        loc1, loc2 = ffs.CODE_MAP.get(o, o), ffs.CODE_MAP.get(d, d)
+        # Some ODs leave FN blank on their structure RBD rows (levels above 8),
+        # which only the FN-less baggage lookup of structure RBDs can find
+        blank_fn = i % BLANK_FN_EVERY == 0
+        for trip in (1, 2):
+            for rbd in LEVELS + ['GH']:
+                structure = rbd in LEVELS[8:]
+                for brand in (BRANDS if rbd != 'GH' else BRANDS[:3]):
+                    for fn in FNS:
+                        base = rnd.randint(20, 900)
+                        rows.append((
+                            'IPRMEA', 'G9', 'KW', 'AZ', loc1, loc2, 'R1', f'{d}{rbd}{trip}{brand[-1]}-{fn}',
+                            trip, rnd.randint(0, 99), None if blank_fn and structure else fn, CURRENCY[o], base,
+                            start + timedelta(days=rnd.randint(0, 200)), 'INF', rnd.randint(1000, 9999),
+                            rbd, brand, rnd.choice([20, 30, 40, 50]), base, base + 30))
+    rows.extend(edge_atpco_rows(start))
+    for origin, dest, *_ in EDGE_CASES.values():
+        taxes[(origin, dest, 'OW')] = taxes[(origin, dest, 'RT')] = EDGE_TAX
+    atpco = pd.DataFrame(rows, columns=['Tariff', 'CXR', 'NAT1', 'NAT2', 'LOC1', 'LOC2', 'Rule', 'FareClass',
+                                        'OW/RT', 'RTG', 'FN', 'CUR', 'Amount', 'Eff.Date', 'Disc.Date', 'GFSFAN',
+                                        'RBD', 'BRAND', 'BAG', 'BASE FARE', 'TOTAL FARE'])
+    all_dests = dests + [NO_ATPCO_DEST]
+    blank_tfee = [EDGE_CASES['missing tfee'][:2]]
+    sheets = {
+        'FCR': pd.DataFrame({'Fare Level': range(1, len(LEVELS) + 1), 'Fare Class': LEVELS}),
+        'Tax': pd.DataFrame([(o, d, j, *values) for (o, d, j), values in taxes.items()],
+                            columns=['Origin', 'Destination', 'JourneyType', 'FixedTaxTotal', 'YQ', 'YR']),
+        'Exchange Rates': pd.DataFrame({'Currency': [f'{c}/AED' for c in RATES] + ['USD/AED'],
+                                        'Price': list(RATES.values()) + [3.6725]}),
+        'ATPCO Data': atpco,
+        # SLL is left off: the script accepts it as an origin whenever the list isn't empty
+        'Fare Calc OD': pd.DataFrame({'Origin': pd.Series([o for o in ORIGINS if o != 'SLL']),
+                                      'Destination': pd.Series(all_dests[:len(all_dests) // 2]),
+                                      'All Destination': pd.Series(all_dests + [case[1] for case in EDGE_CASES.values()])}),
+        'Tfee discount': pd.DataFrame({'Ods': [o + d for o, d in ods[::3]] + [o + d for o, d in blank_tfee],
+                                       'OW': [rnd.choice([0, 1.5, 2]) for _ in ods[::3]] + [None] * len(blank_tfee),
+                                       'RT': [rnd.choice([0, 3, 4]) for _ in ods[::3]] + [None] * len(blank_tfee)}),
+        'Restricted OD': pd.DataFrame(RESTRICTED, columns=['Origin', 'Destination']),
+    }
+    with pd.ExcelWriter(path) as writer:
+        for name, df in sheets.items():
+            df.to_excel(writer, sheet_name=name, index=False)
+    return ods, taxes
+
+#B1 total fare whose base fare with YQ in AED falls inside the RBD's fare ladder band
+def b1_for(rnd, rbd, trip, currency, fixed_tax):
+    low, high = next((low, min(high, 9000)) for t, r, low, high, _ in ffs.DEFAULT_FARE_LADDER
+                     if t == trip and r == rbd)
+    aed = rnd.uniform(low + 1, high - 1)
+    return round(aed / RATES[currency] + fixed_tax, 2)
+
+#One input row [O, D, O/R, RBD, CURRENCY, B1] for a path of INPUT_MIX
+def make_input_row(rnd, path, ods, taxes):
+    o, d = rnd.choice(ods)
+    trip = rnd.choice([1, 2])
+    currency = CURRENCY[o]
+    fixed_tax = taxes[(o, d, 'OW' if trip == 1 else 'RT')][0]
+    # Fare's RBD, mostly below the structure levels
+    level = rnd.randint(2, 8) if rnd.random() < 0.9 else rnd.randint(9, 14)
+    b1 = b1_for(rnd, LEVELS[level - 1], trip, currency, fixed_tax)
+    if path == 'new':
+        filed = min(level + rnd.randint(1, 3), len(LEVELS))
+    elif path == 'delete':
+        filed = max(level - rnd.randint(1, 3), 1)
+    else:
+        filed = level
+    row = [o, d, trip, LEVELS[filed - 1], currency, b1]
+    if path != 'reject':
+        return row
+    reject = rnd.choice(REJECTS)
+    if reject == 'missing data':
+        row[1] = None
+    elif reject == 'bad B1':
+        row[5] = 'abc'
+    elif reject == 'restricted OD':
+        row[0], row[1] = rnd.choice(RESTRICTED)
+        row[4] = CURRENCY[row[0]]
+    elif reject == 'bad origin':
+        row[0] = 'XXX'
+    elif reject == 'bad destination':
+        row[1] = 'YYY'
+    elif reject == 'bad trip':
+        row[2] = 3
+    elif reject == 'bad RBD':
+        row[3] = 'BB'
+    elif reject == 'bad currency':
+        row[4] = 'USD'
+    elif reject == 'missing ATPCO':
+        row[1] = NO_ATPCO_DEST
+    elif reject == 'low fare':
+        row[5] = 1.0
+    return row
+
+#Write an input.xlsx with the SALES/TRAVEL/FN header, n rows drawn from INPUT_MIX and
+#one row per EDGE_CASES entry
+def make_input(path, n, ods, taxes, seed=1, sales='Imm till 31Aug25'):
+    rnd = random.Random(seed)
+    paths = rnd.choices(list(INPUT_MIX), weights=list(INPUT_MIX.values()), k=n)
+    rows = [make_input_row(rnd, p, ods, taxes) for p in paths]
+    for origin, dest, trip, filed, level, offset in EDGE_CASES.values():
+        rows.append([origin, dest, trip, LEVELS[filed - 1], CURRENCY[origin],
+                     edge_fares(origin, trip, level, offset)[1]])
+    top = [['Sep', None, None, None, None, None],
+           ['SALES', 'TRAVEL', 'FN', None, None, None],
+           [sales, sales, FNS[0], None, None, None],
+           ['O', 'D', 'O/R', 'RBD', 'CURRENCY', 'B1']]
+    pd.DataFrame(top + rows).to_excel(path, header=False, index=False, sheet_name='Sheet1')
+
+#Run one filing with each stage timed; returns ({stage: seconds}, counts)
+def run_once(data_path, input_path, output_path, workers=1, write_only=False, status='none'):
+    timings = {}
+    t = time.perf_counter()
+    reference = ffs.ReferenceData(data_path)
+    # Sheets are parsed on first use; parse them all here so 'load' stays the full read
+    reference.load()
+    processor = ffs.FareFilingProcessor(input_path, reference=reference, output_path=output_path,
+                                        write_only=write_only, interactive=False, status=status)
+    timings['load'] = time.perf_counter() - t
+
+    t = time.perf_counter()
+    valid = processor.validate()
+    timings['validate'] = time.perf_counter() - t
+
+    t = time.perf_counter()
+    rows = ffs.pricing_rows(processor.enrich(processor.df_table[valid]))
+    results = list(ffs.price_rows(processor.context, rows, workers))
+    timings['price'] = time.perf_counter() - t
+
+    t = time.perf_counter()
+    for idx, result in results:
+        processor.record(idx, result)
+    timings['write'] = time.perf_counter() - t
+
+    t = time.perf_counter()
+    processor.output.save(output_path)
+    processor.write_status()
+    timings['save'] = time.perf_counter() - t
+
+    completed = processor.df_table['COMPLETED'].value_counts().to_dict()
+    counts = {'input_rows': len(processor.df_table), 'priced_rows': len(rows),
+              'delete_rows': sum(len(r.delete) for _, r in results),
+              'file_rows': sum(len(r.file) for _, r in results),
+              'gh_rows': sum(len(r.gh) for _, r in results),
+              'completed': {str(k): int(v) for k, v in completed.items()}}
+    return timings, counts
+
+#Commit of the script being measured, when it is in a git checkout
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+#Start-up of the script as a user sees it: seconds until "Filing script is running..."
+#is printed (on a folder with no inputs, so the run stops there), and the import time of
+#the script with its slowest imports, as `python -X importtime` reports them
+def startup_report(repeat=3, top=8):
+    script = os.path.abspath(ffs.__file__)
+    empty = tempfile.mkdtemp(prefix='filing_startup_')
+    first_output = []
+    for _ in range(repeat):
+        t = time.perf_counter()
+        with subprocess.Popen([sys.executable, script, '--non-interactive', '-i', empty],
+                              stdout=subprocess.PIPE, text=True) as run:
+            run.stdout.readline()
+            first_output.append(time.perf_counter() - t)
+            run.communicate()
+    done = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import fare_filing_script'],
+                          capture_output=True, text=True, cwd=os.path.dirname(script))
+    # Lines are 'import time: self [us] | cumulative | imported package'
+    imports = []
+    for line in done.stderr.splitlines():
+        parts = line.split('|')
+        if len(parts) == 3 and parts[1].strip().isdigit():
+            imports.append((int(parts[1]) / 1e6, parts[2].strip()))
+    script_import = max((seconds for seconds, name in imports if name == 'fare_filing_script'), default=None)
+    slowest = sorted((entry for entry in imports if entry[1] != 'fare_filing_script'), reverse=True)[:top]
+    return {'first_output': {'min': min(first_output), 'median': statistics.median(first_output)},
+            'import_seconds': script_import,
+            'slowest_imports': [{'module': name, 'seconds': seconds} for seconds, name in slowest]}
+
+def print_startup(startup, previous=None):
+    line = (f"startup: first output {startup['first_output']['min']:.3f}s min "
+            f"{startup['first_output']['median']:.3f}s median")
+    if previous:
+        line += f"   x{startup['first_output']['min'] / max(previous['first_output']['min'], 1e-9):.2f} vs previous"
+    print(line)
+    if startup['import_seconds'] is not None:
+        print(f"  import fare_filing_script {startup['import_seconds']:.3f}s, slowest imports:")
+    for entry in startup['slowest_imports']:
+        print(f"    {entry['module']:<32} {entry['seconds']:.3f}s")
+
+#Generate the workbooks for one ATPCO size and time repeat runs of them
+def bench_case(workdir, atpco_rows, args):
+    case_dir = os.path.join(workdir, f'atpco_{atpco_rows}')
+    os.makedirs(case_dir, exist_ok=True)
+    data_path = os.path.join(case_dir, 'data.xlsx')
+    input_path = os.path.join(case_dir, 'input.xlsx')
+    t = time.perf_counter()
+    ods, taxes = make_data(data_path, atpco_rows, seed=args.seed)
+    make_input(input_path, args.rows, ods, taxes, seed=args.seed)
+    generate = time.perf_counter() - t
+    runs = []
+    for _ in range(args.repeat):
+        timings, counts = run_once(data_path, input_path, os.path.join(case_dir, 'output.xlsx'),
+                                   workers=args.workers, write_only=args.write_only, status=args.status)
+        runs.append(timings)
+    stages = {stage: {'min': min(r[stage] for r in runs),
+                      'median': statistics.median(r[stage] for r in runs)}
+              for stage in runs[0]}
+    stages['total'] = {'min': min(sum(r.values()) for r in runs),
+                       'median': statistics.median(sum(r.values()) for r in runs)}
+    return {'case': f'atpco={atpco_rows} rows={args.rows}', 'atpco_rows': atpco_rows,
+            'input_rows': args.rows, 'generate_seconds': generate, 'stages': stages, 'counts': counts}
+
+def print_case(case, previous=None):
+    print(case['case'])
+    for stage, times in case['stages'].items():
+        line = f"  {stage:<9} {times['min']:9.3f}s min {times['median']:9.3f}s median"
+        if previous and stage in previous['stages']:
+            line += f"   x{times['min'] / max(previous['stages'][stage]['min'], 1e-9):.2f} vs previous"
+        print(line)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Time fare_filing_script on synthetic workbooks.")
+    parser.add_argument('--atpco', type=int, nargs='+', default=[10000],
+                        help="ATPCO Data sizes to generate (rows), e.g. 10000 100000 1000000")
+    parser.add_argument('--rows', type=int, default=1000, help="input rows")
+    parser.add_argument('--repeat', type=int, default=3, help="timed runs per size")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('-w', '--workers', type=int, default=1, help="pricing processes")
+    parser.add_argument('--write-only', action='store_true', help="stream the output workbook")
+    parser.add_argument('--status', choices=['source', 'csv', 'xlsx', 'parquet', 'none'], default='none',
+                        help="status write-back timed in the save stage")
+    parser.add_argument('--workdir', help="keep the generated workbooks here (default: a temp folder)")
+    parser.add_argument('--json', help="write the results to this file")
+    parser.add_argument('--compare', help="results file of an earlier run to compare against")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    workdir = args.workdir or tempfile.mkdtemp(prefix='filing_bench_')
+    previous, previous_startup = {}, None
+    if args.compare:
+        with open(args.compare) as f:
+            compared = json.load(f)
+        previous = {case['case']: case for case in compared['cases']}
+        previous_startup = compared.get('startup')
+    results = {'revision': git_revision(), 'date': datetime.now().isoformat(timespec='seconds'),
+               'python': platform.python_version(), 'pandas': pd.__version__,
+               'cpus': os.cpu_count(), 'workers': args.workers, 'write_only': args.write_only,
+               'status': args.status, 'startup': startup_report(), 'cases': []}
+    print_startup(results['startup'], previous_startup)
+    for atpco_rows in args.atpco:
+        case = bench_case(workdir, atpco_rows, args)
+        results['cases'].append(case)
+        print_case(case, previous.get(case['case']))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"Results written to {args.json}")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,12 +1,52 @@
 import os
 import sys
-import pandas as pd
-from openpyxl import Workbook
-from openpyxl.styles import PatternFill,Font
-from openpyxl import load_workbook
+import json
+import pickle
+import shutil
+import hashlib
+import importlib
+import importlib.util
+import argparse
+import glob
+import traceback
+import heapq
+import time
+import queue
+import threading
+import cProfile
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
+from collections import namedtuple, OrderedDict, Counter
 import math
 
+#Import a module when one of its attributes is first used. numpy, pandas and openpyxl
+#take most of the start-up time (above all in the frozen exe), so they are only loaded
+#once the run needs them, after "Filing script is running..." is shown.
+def lazy_import(name):
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None or not hasattr(spec.loader, 'exec_module'):
+        return importlib.import_module(name)
+    spec.loader = importlib.util.LazyLoader(spec.loader)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+openpyxl = lazy_import('openpyxl')
+
+#Load the lazily imported modules now, before starting threads that use them:
+#a lazy module must not be loaded by two threads at once
+def load_modules():
+    for module in (np, pd, openpyxl):
+        getattr(module, '__version__', None)
+
 #Get the directory in which the file is located
 def get_base_dir():
     if getattr(sys, 'frozen', False):
@@ -22,49 +62,1032 @@ def resolve_path_output(filename):
 def resolve_path_input(filename):
     return os.path.join(get_base_dir(), 'source', filename)
 
+#A workbook is open (locked by Excel) when it can't be opened for appending; a file
+#that doesn't exist yet isn't open
 def is_file_open(file_location):
+    if not os.path.exists(file_location):
+        return False
     try:
         with open(file_location, 'a'):
             return False
     except PermissionError:
         return True
 
+#Excel reader for pandas: calamine when asked for ('calamine', or 'auto') and installed,
+#otherwise pandas' default (openpyxl)
+def excel_engine(preferred=None):
+    if preferred in ('calamine', 'auto') and importlib.util.find_spec('python_calamine') is not None:
+        return 'calamine'
+    if preferred == 'calamine':
+        print("python-calamine is not installed, reading with openpyxl")
+    return None
+
+#Size and modification time of a file, plus a hash of its contents when asked
+def file_fingerprint(path, content_hash=False):
+    stat = os.stat(path)
+    key = {'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+    if content_hash:
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+        key['sha256'] = digest.hexdigest()
+    return key
+
+#Parsed sheets of a workbook pickled in a folder next to it (e.g. data.xlsx.cache/).
+#The folder's manifest records the workbook fingerprint, the columns read and the sheet
+#names; the cache is only used while they still match, and is rebuilt otherwise.
+#Sheets are added to it one by one as they are first parsed.
+class SheetCache:
+    def __init__(self, source_path, content_hash=False, columns=None):
+        self.dir = source_path + '.cache'
+        self.manifest_path = os.path.join(self.dir, 'manifest.json')
+        self.key = dict(file_fingerprint(source_path, content_hash), columns=columns)
+        self.manifest = None
+        try:
+            with open(self.manifest_path) as f:
+                manifest = json.load(f)
+            if manifest.get('key') == self.key:
+                self.manifest = manifest
+        except (OSError, ValueError):
+            pass
+
+    def sheet_path(self, name):
+        return os.path.join(self.dir, name.replace(' ', '_') + '.pkl')
+
+    # Sheet names of the workbook, or None when the cache doesn't know them
+    def sheet_names(self):
+        return None if self.manifest is None else self.manifest['sheet_names']
+
+    # Cached frame of a sheet, or None when it isn't cached
+    def load(self, name):
+        if self.manifest is None or name not in self.manifest['cached']:
+            return None
+        with open(self.sheet_path(name), 'rb') as f:
+            return pickle.load(f)
+
+    # Add a freshly parsed sheet, starting a new cache when the old one is stale;
+    # a read-only folder just means no cache
+    def store(self, sheet_names, name, df):
+        try:
+            if self.manifest is None:
+                shutil.rmtree(self.dir, ignore_errors=True)
+                os.makedirs(self.dir)
+                self.manifest = {'key': self.key, 'sheet_names': list(sheet_names), 'cached': []}
+            with open(self.sheet_path(name), 'wb') as f:
+                pickle.dump(df, f, protocol=pickle.HIGHEST_PROTOCOL)
+            self.manifest['cached'].append(name)
+            with open(self.manifest_path, 'w') as f:
+                json.dump(self.manifest, f)
+        except OSError:
+            self.manifest = None
+
+#Sheets of a workbook, each parsed on first use and reading only its listed columns.
+#columns maps sheet name -> {column: dtype}; a None dtype leaves the type to pandas.
+#cache=True (or 'hash' to also compare file contents) reuses a SheetCache while the file is unchanged.
+class SheetReader:
+    def __init__(self, path, columns, cache=False, engine=None):
+        self.path = path
+        self.columns = columns
+        self.engine = engine
+        self.cache = SheetCache(path, content_hash=(cache == 'hash'), columns=columns) if cache else None
+        self.xls = None
+
+    # The workbook, opened on first use (openpyxl only loads a sheet once it is parsed)
+    def workbook(self):
+        if self.xls is None:
+            self.xls = pd.ExcelFile(self.path, engine=self.engine)
+        return self.xls
+
+    def sheet_names(self):
+        names = self.cache.sheet_names() if self.cache is not None else None
+        return names if names is not None else self.workbook().sheet_names
+
+    # Parsed sheet, or None when the workbook doesn't have it. Listed columns missing
+    # from the sheet are left out here and fail where they are used.
+    def read(self, name):
+        if name not in self.sheet_names():
+            return None
+        if self.cache is not None:
+            df = self.cache.load(name)
+            if df is not None:
+                return df
+        wanted = self.columns[name]
+        df = pd.read_excel(self.workbook(), sheet_name=name, usecols=lambda col: col in wanted,
+                           dtype={col: dtype for col, dtype in wanted.items() if dtype is not None})
+        if self.cache is not None:
+            self.cache.store(self.workbook().sheet_names, name, df)
+        return df
+
+    def close(self):
+        if self.xls is not None:
+            self.xls.close()
+            self.xls = None
+
+    # Worker processes reopen the workbook if they need it
+    def __getstate__(self):
+        return dict(self.__dict__, xls=None)
+
 # Mapping for special destination codes
 CODE_MAP = {
     'SAW': 'IST', 'OTP': 'BUH', 'BGY': 'MIL',
     'IKA': 'THR', 'GYD': 'BAK', 'ESB': 'ANK', 'VKO' : 'MOW'
 }
 
+# Highlight for duplicate FBCs on the FILE sheet
+DUPE_COLOR = 'FFC7CE'
+
+# Currencies the script can file in
+CURRENCIES = ('BHD', 'KWD', 'QAR', 'SAR', 'OMR')
+
 #Round to the nearest integer
 def round_nearest(num):
         return math.floor(num+1)
 
-class FareFilingProcessor:
-    def __init__(self, input_path, data_path):
-        input_path = resolve_path_input(input_path)
-        data_path = resolve_path_input(data_path)
+#Strip text cells, leave blanks and numbers alone
+def strip_text(value):
+    return value.strip() if isinstance(value, str) else value
+
+#Stripped text values of a sheet column (blank cells are skipped)
+def text_set(column):
+    return frozenset(value.strip() for value in column if isinstance(value, str))
+
+#ATPCO Data columns kept after loading: the ones written to DELETE and GH rows
+#(see atpco_out) and the fares and baggage pricing reads
+ATPCO_COLUMNS = ['Tariff', 'CXR', 'NAT1', 'NAT2', 'LOC1', 'LOC2', 'Rule', 'FareClass', 'OW/RT',
+                 'RTG', 'FN', 'CUR', 'Amount', 'Eff.Date', 'Disc.Date', 'GFSFAN', 'BASE FARE', 'BAG']
+# Key columns of an ATPCO lookup, in key order; OW/RT is matched as is, the rest stripped
+ATPCO_KEY = ['LOC1', 'LOC2', 'RBD', 'BRAND', 'FN', 'OW/RT']
+
+#Smallest signed integer type holding codes 0..size (and -1 for blanks)
+def code_dtype(size):
+    for dtype in (np.int8, np.int16, np.int32):
+        if size < np.iinfo(dtype).max:
+            return dtype
+    return np.int64
+
+#ATPCO Data sheet normalised once into compact arrays, with its lookup index.
+#Numeric columns stay numeric arrays; every other column is stored as small-int codes
+#into its distinct values. Lookups go through one int64 key per row (the mixed-radix
+#number of its stripped LOC1/LOC2/RBD/BRAND/FN codes and OW/RT), kept sorted with the
+#first row position for each key: 'full' keys carry the FN, 'no_fn' keys leave it out
+#for the FN-less (structure RBD) lookups. Rows with a blank key cell are never found,
+#except by the FN-less lookups when the blank cell is FN.
+class AtpcoTable:
+    def __init__(self, df_atpco):
+        # Lookups made, for RunStats
+        self.lookups = 0
+        self.values = {}
+        self.labels = {}
+        for col in ATPCO_COLUMNS:
+            column = df_atpco[col]
+            if column.dtype.kind in 'iuf':
+                self.values[col] = column.to_numpy()
+            else:
+                codes, uniques = pd.factorize(column)
+                self.values[col] = codes.astype(code_dtype(len(uniques)))
+                self.labels[col] = list(uniques)
+        # Per key column: stripped value (OW/RT: value) -> key code, and each row's key code
+        self.key_codes = []
+        row_codes = []
+        for col in ATPCO_KEY:
+            codes, uniques = pd.factorize(df_atpco[col])
+            if col == 'OW/RT':
+                lookup = {value: code for code, value in enumerate(uniques)}
+                label_codes = np.arange(len(uniques))
+            else:
+                lookup = {}
+                label_codes = np.array([lookup.setdefault(value.strip(), len(lookup)) if isinstance(value, str) else -1
+                                        for value in uniques], dtype=np.int64)
+            self.key_codes.append(lookup)
+            # Blank cells (code -1) and non-text key values stay -1
+            row_codes.append(np.where(codes >= 0, label_codes[codes] if len(uniques) else codes, -1))
+        self.radix = [len(lookup) + 1 for lookup in self.key_codes]
+        valid = np.logical_and.reduce([codes >= 0 for codes in row_codes[:-1]])
+        # FN-less lookups don't look at FN, so a blank FN doesn't keep a row out of them
+        valid_no_fn = np.logical_and.reduce([codes >= 0 for col, codes in zip(ATPCO_KEY[:-1], row_codes)
+                                             if col != 'FN'])
+        # OW/RT blanks are kept, as the key slot 0 that no lookup asks for
+        row_codes[-1] = row_codes[-1] + 1
+        self.full = self.key_index(row_codes, valid, self.radix)
+        no_fn = [codes for col, codes in zip(ATPCO_KEY, row_codes) if col != 'FN']
+        self.no_fn_radix = [r for col, r in zip(ATPCO_KEY, self.radix) if col != 'FN']
+        self.no_fn = self.key_index(no_fn, valid_no_fn, self.no_fn_radix)
+        # GH rows grouped on their (LOC1, LOC2, FN, OW/RT) codes -> {brand: first row position}
+        self.gh = {}
+        gh_code = self.key_codes[2].get('GH')
+        brands = {code: brand for brand, code in self.key_codes[3].items()}
+        if gh_code is not None:
+            rows = np.flatnonzero(valid & (row_codes[2] == gh_code))
+            group_codes = [row_codes[i][rows].tolist() for i in (0, 1, 4, 5, 3)]
+            for pos, loc1, loc2, fn, trip, brand in zip(rows.tolist(), *group_codes):
+                self.gh.setdefault((loc1, loc2, fn, trip), {}).setdefault(brands[brand], pos)
+        # Eff.Date codes -> the date as written to the output, formatted on first use
+        self.eff_dates = {}
+
+    # (sorted keys, first row position of each) over the valid rows
+    @staticmethod
+    def key_index(row_codes, valid, radix):
+        if math.prod(radix) >= 2 ** 63:
+            raise ValueError("ATPCO Data has too many distinct key values to index")
+        keys = np.zeros(len(valid), dtype=np.int64)
+        for codes, r in zip(row_codes, radix):
+            keys = keys * r + codes
+        positions = np.flatnonzero(valid)
+        keys, first = np.unique(keys[positions], return_index=True)
+        return keys, positions[first].astype(np.int32 if len(valid) < 2 ** 31 else np.int64)
+
+    # Key number of the looked-up values (OW/RT last), or None when one of them is not in ATPCO
+    def key(self, values, columns, radix):
+        key = 0
+        for value, col, r in zip(values, columns, radix):
+            code = self.key_codes[col].get(value)
+            if code is None:
+                return None
+            key = key * r + code
+        # OW/RT codes are stored shifted by one (see __init__)
+        return key + 1
+
+    def search(self, index, key):
+        if key is None:
+            return None
+        keys, positions = index
+        i = keys.searchsorted(key)
+        return int(positions[i]) if i < len(keys) and keys[i] == key else None
+
+    def find(self, origin, dest, rbd, brand, fn, trip):
+        self.lookups += 1
+        values = (CODE_MAP.get(origin, origin), CODE_MAP.get(dest, dest), rbd, brand, fn, trip)
+        return self.search(self.full, self.key(values, range(6), self.radix))
+
+    def find_any_fn(self, origin, dest, rbd, brand, trip):
+        self.lookups += 1
+        values = (CODE_MAP.get(origin, origin), CODE_MAP.get(dest, dest), rbd, brand, trip)
+        return self.search(self.no_fn, self.key(values, (0, 1, 2, 3, 5), self.no_fn_radix))
+
+    # find for several (rbd, brand) pairs of one OD, FN and trip, searched in one go;
+    # returns the row positions (None where there is no row) in the order of the pairs
+    def find_many(self, origin, dest, fn, trip, pairs):
+        self.lookups += len(pairs)
+        origin, dest = CODE_MAP.get(origin, origin), CODE_MAP.get(dest, dest)
+        keys = [self.key((origin, dest, rbd, brand, fn, trip), range(6), self.radix) for rbd, brand in pairs]
+        index_keys, positions = self.full
+        if not len(index_keys):
+            return [None] * len(keys)
+        probe = np.array([-1 if key is None else key for key in keys], dtype=np.int64)
+        i = np.minimum(index_keys.searchsorted(probe), len(index_keys) - 1)
+        hit = index_keys[i] == probe
+        return [int(pos) if found else None for pos, found in zip(positions[i].tolist(), hit.tolist())]
+
+    # GH rows of an OD, FN and trip in one probe: {brand: row position}, empty when there are none
+    def find_gh(self, origin, dest, fn, trip):
+        self.lookups += 1
+        codes = [self.key_codes[col].get(value) for col, value in
+                 ((0, CODE_MAP.get(origin, origin)), (1, CODE_MAP.get(dest, dest)), (4, fn), (5, trip))]
+        if None in codes:
+            return {}
+        # OW/RT codes are stored shifted by one (see __init__)
+        codes[3] += 1
+        return self.gh.get(tuple(codes), {})
+
+    # Eff.Date of a row as written to the DELETE and GH sheets (dd/mm/yy)
+    def eff_date(self, pos):
+        code = self.values['Eff.Date'][pos]
+        text = self.eff_dates.get(code)
+        if text is None:
+            text = self.eff_dates[code] = self.value(pos, 'Eff.Date').strftime("%d/%m/%y")
+        return text
+
+    # Cell of a kept column at a row position, as read from the sheet (NaN for blanks)
+    def value(self, pos, col):
+        value = self.values[col][pos]
+        if col not in self.labels:
+            return value.item()
+        return np.nan if value < 0 else self.labels[col][value]
+
+    # Kept cells of the row at a position, read by column name as they are asked for
+    def row(self, pos):
+        return AtpcoRow(self, pos)
+
+    # Distinct values of a kept text column (blanks left out)
+    def distinct(self, col):
+        return self.labels[col]
+
+#One row of an AtpcoTable: row['Amount'] reads that cell (see AtpcoTable.value)
+class AtpcoRow:
+    __slots__ = ('table', 'pos')
+
+    def __init__(self, table, pos):
+        self.table = table
+        self.pos = pos
+
+    def __getitem__(self, col):
+        return self.table.value(self.pos, col)
+
+    def eff_date(self):
+        return self.table.eff_date(self.pos)
+
+# Fare ladder: for each trip type and RBD, the band of B1 base fares with YQ in AED
+# that file in that RBD, and the Brand 1 fare with YQ in AED built for the RBD.
+# A 'Fare Ladder' sheet in data.xlsx with these columns replaces the default.
+FARE_LADDER_COLUMNS = ['OW/RT', 'RBD', 'Low', 'High', 'B1 Fare']
+DEFAULT_FARE_LADDER = [
+    (1, 'L', 50, 389, 325), (1, 'Q', 390, 454, 390), (1, 'H', 455, 532, 455), (1, 'K', 533, 623, 533),
+    (1, 'U', 624, 714, 624), (1, 'B', 715, 831, 715), (1, 'R', 832, 987, 832), (1, 'N', 988, 1182, 988),
+    (1, 'M', 1183, 1377, 1183), (1, 'T', 1378, 1637, 1378), (1, 'W', 1638, 1962, 1638), (1, 'O', 1963, 2352, 1963),
+    (1, 'E', 2353, 2807, 2353), (1, 'I', 2808, 3262, 2808), (1, 'A', 3263, 3782, 3263), (1, 'Y', 3783, 999999999999999, 3783),
+    (2, 'L', 100, 599, 500), (2, 'Q', 600, 699, 600), (2, 'H', 700, 819, 700), (2, 'K', 820, 959, 820),
+    (2, 'U', 960, 1099, 960), (2, 'B', 1100, 1279, 1100), (2, 'R', 1280, 1519, 1280), (2, 'N', 1520, 1819, 1520),
+    (2, 'M', 1820, 2119, 1820), (2, 'T', 2120, 2519, 2120), (2, 'W', 2520, 3019, 2520), (2, 'O', 3020, 3619, 3020),
+    (2, 'E', 3620, 4319, 3620), (2, 'I', 4320, 5019, 4320), (2, 'A', 5020, 5819, 5020), (2, 'Y', 5820, 999999999999999, 5820),
+]
+
+#Fare ladder lookups: bands are kept sorted per trip type and searched by their lower bound
+class FareLadder:
+    def __init__(self, table):
+        self.lows = {}
+        self.highs = {}
+        self.rbds = {}
+        for trip, rows in table.sort_values('Low').groupby('OW/RT'):
+            self.lows[trip] = rows['Low'].to_numpy(dtype=float)
+            self.highs[trip] = rows['High'].to_numpy(dtype=float)
+            self.rbds[trip] = rows['RBD'].to_numpy(dtype=object)
+        self.b1_fares = dict(zip(zip(table['OW/RT'], table['RBD']), table['B1 Fare']))
+
+    # RBD whose band holds each amount for its trip type, or None
+    def rbds_for(self, amounts, trips):
+        amounts = np.asarray(amounts, dtype=float)
+        trips = np.asarray(trips)
+        out = np.full(len(amounts), None, dtype=object)
+        for trip, lows in self.lows.items():
+            rows = np.flatnonzero(trips == trip)
+            i = np.searchsorted(lows, amounts[rows], side='right') - 1
+            found = (i >= 0) & (amounts[rows] <= self.highs[trip][np.maximum(i, 0)])
+            out[rows[found]] = self.rbds[trip][i[found]]
+        return out
+
+    # Brand 1 fare with YQ in AED for the RBD
+    def b1_fare(self, rbd, trip):
+        return self.b1_fares[(trip, rbd)]
+
+# Brands in the order their FILE rows are written, with the channel each is sold on
+BRAND_CHANNELS = {'Brand 1': 'WEB', 'Brand 2': 'WEB', 'GDS 1': 'GDS', 'Brand 3': 'WEB', 'GDS 2': 'GDS'}
+
+# AED bands (upper bounds, inclusive) for the Brand 2 differential and the GDS segment fee
+AED_BANDS = [500, 1000, 1500, 2000]
+AED_BAND_FEES = {1: [20, 30, 40, 50, 80], 2: [40, 60, 80, 100, 160]}
+
+# Filed and carried fares for one brand (arrays, one entry per priced row)
+BrandFares = namedtuple('BrandFares', ['base', 'total', 'ladder_base', 'ladder_total'])
+
+#Vectorised round_nearest as applied when a fare is filed: whole fares are kept as they are
+def round_fares(fares):
+    return np.where(fares == np.trunc(fares), fares, np.floor(fares + 1))
+
+#Band fee in AED for a fare in AED, one-way or return
+def aed_band_fee(fare_aed, trip):
+    band = np.searchsorted(AED_BANDS, fare_aed, side='left')
+    return np.where(trip == 1, np.take(AED_BAND_FEES[1], band), np.take(AED_BAND_FEES[2], band))
+
+#Price the brand ladder (Brand 1 -> Brand 2 -> GDS 1 -> Brand 3 -> GDS 2) for arrays of rows.
+#Arguments are arrays (or scalars) in the filing currency, except exch which converts it to AED.
+#level is the filed fare level and fod_od flags ODs listed on the Fare Calc OD sheet.
+#With chain=True every brand is priced from the filed (rounded) fare of the one before it,
+#as an AMEND does; otherwise the unrounded fares are carried down the ladder.
+#filed_base maps brand -> current ATPCO base fare (NaN when none); a fare that would be
+#filed unchanged is bumped by 1.
+#Returns {brand: BrandFares}, giving the same fares as filing one row at a time.
+def price_brands(b1_base, b1_total, exch, tax, yq, tfee, trip, level, fod_od,
+                 chain=False, filed_base=None):
+    b1_base, b1_total, exch, tax, yq, tfee, level = (
+        np.asarray(a, dtype=float) for a in (b1_base, b1_total, exch, tax, yq, tfee, level))
+    trip = np.asarray(trip)
+    fares = {}
+
+    def file(brand, base, total):
+        filed = round_fares(base)
+        filed_total = round_fares(total)
+        if filed_base is not None:
+            same = filed == np.asarray(filed_base[brand], dtype=float)
+            filed = filed + same
+            filed_total = filed_total + same
+        if chain:
+            base, total = filed, filed_total
+        fares[brand] = BrandFares(filed, filed_total, base, total)
+        return base, total
+
+    b1_base, b1_total = file('Brand 1', b1_base, b1_total)
+
+    b2_total = b1_total + aed_band_fee(b1_total * exch, trip) / exch
+    b2_base = b2_total - tax - yq
+    b2_base, b2_total = file('Brand 2', b2_base, b2_total)
+
+    segment_fee = aed_band_fee(b2_total * exch, trip) / exch
+    gds1_base = np.where((level <= 5) & np.asarray(fod_od, dtype=bool),
+                         b2_base + segment_fee - tfee, b2_base + segment_fee)
+    gds1_total = gds1_base + tax + yq + tfee
+    gds1_base, gds1_total = file('GDS 1', gds1_base, gds1_total)
+
+    b3_total = gds1_total + np.where(trip == 1, 100, 200) / exch
+    b3_base = b3_total - yq - tax
+    b3_base, b3_total = file('Brand 3', b3_base, b3_total)
+
+    flex = np.where((level >= 1) & (level <= 13), 0.05, 0.1)
+    gds2_base = b3_base + (flex * (b3_base + yq)) + segment_fee
+    gds2_total = gds2_base + yq + tax + tfee
+    file('GDS 2', gds2_base, gds2_total)
+    return fares
+
+#Stage timings, counters and peak memory of a run (--stats), written as a JSON summary.
+#Stages with the same name add up, e.g. over the inputs of a batch. Peak memory is the
+#process's peak RSS where the platform reports it; trace_memory=True also traces Python
+#allocations with tracemalloc, which slows the run (and its stage timings) down a lot.
+#data.xlsx sheets are read lazily, in whatever stage first needs them: each read is its
+#own read_<structure> stage (see read) and is left out of the stages it happens in.
+class RunStats:
+    def __init__(self, trace_memory=False):
+        self.started = time.perf_counter()
+        self.stages = {}
+        # Stages open on each thread, innermost last
+        self.open = threading.local()
+        self.counters = Counter()
+        self.outcomes = Counter()
+        self.output_rows = Counter()
+        self.trace_memory = trace_memory
+        if trace_memory:
+            tracemalloc.start()
+
+    def open_stages(self):
+        return self.open.__dict__.setdefault('stages', [])
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        stack = self.open_stages()
+        stack.append(name)
+        try:
+            yield
+        finally:
+            stack.pop()
+            self.stages[name] = self.stages.get(name, 0) + time.perf_counter() - start
+
+    # Stage read_<name> for building a ReferenceData structure from its sheet (see
+    # loaded_once). Its time is taken out of the stages open around it on this thread.
+    @contextmanager
+    def read(self, name):
+        start = time.perf_counter()
+        try:
+            with self.stage('read_' + name):
+                yield
+        finally:
+            elapsed = time.perf_counter() - start
+            for outer in set(self.open_stages()):
+                self.stages[outer] = self.stages.get(outer, 0) - elapsed
+
+    def count(self, name, n=1):
+        self.counters[name] += n
+
+    # Peak resident memory of the process in MB, or None where it isn't reported (Windows)
+    def peak_rss(self):
+        if importlib.util.find_spec('resource') is None:
+            return None
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # kilobytes on Linux, bytes on macOS
+        return round(peak / (2**20 if sys.platform == 'darwin' else 2**10), 1)
+
+    def summary(self):
+        summary = {'total_seconds': time.perf_counter() - self.started,
+                   'stages': self.stages,
+                   'counters': dict(self.counters),
+                   'outcomes': dict(self.outcomes),
+                   'output_rows': dict(self.output_rows),
+                   'peak_memory_mb': self.peak_rss()}
+        if self.trace_memory:
+            summary['traced_peak_mb'] = round(tracemalloc.get_traced_memory()[1] / 2**20, 1)
+        return summary
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.summary(), f, indent=2, default=int)
+
+#Profile the block into path (--profile): an HTML report with pyinstrument for .html
+#paths when it is installed, cProfile stats (for pstats or snakeviz) otherwise
+@contextmanager
+def profiled(path):
+    if not path:
+        yield
+        return
+    if path.endswith('.html') and importlib.util.find_spec('pyinstrument') is not None:
+        from pyinstrument import Profiler
+        profiler = Profiler()
+        profiler.start()
+        try:
+            yield
+        finally:
+            profiler.stop()
+            with open(path, 'w') as f:
+                f.write(profiler.output_html())
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path)
+
+#Raised when a workbook the run needs is open in Excel
+class FileLockedError(Exception):
+    pass
+
+# Columns read from each data.xlsx sheet ('Fare Ladder' is optional), with the dtype of
+# the text columns; numbers and dates are left to pandas. ATPCO columns written to the
+# output keep pandas' types so they are written back as read.
+DATA_COLUMNS = {
+    'FCR': {'Fare Level': None, 'Fare Class': 'object'},
+    'Tax': {'Origin': 'object', 'Destination': 'object', 'JourneyType': 'object',
+            'FixedTaxTotal': None, 'YQ': None, 'YR': None},
+    'Exchange Rates': {'Currency': 'object', 'Price': None},
+    'ATPCO Data': {**{col: None for col in ATPCO_COLUMNS}, 'RBD': 'object', 'BRAND': 'object'},
+    'Fare Calc OD': {'Origin': 'object', 'Destination': 'object', 'All Destination': 'object'},
+    'Tfee discount': {'Ods': 'object', 'OW': None, 'RT': None},
+    'Restricted OD': {'Origin': 'object', 'Destination': 'object'},
+    'Fare Ladder': {'OW/RT': None, 'RBD': 'object', 'Low': None, 'High': None, 'B1 Fare': None},
+}
 
-        #Check if input file is open
-        if(is_file_open(input_path)):
-            input(f"Close the input file.")
-            return
-        # Read input data
-        self.df_table, self.sales, self.travel, self.fn = self.read_input(input_path)
-        # Read  data sheet
-        (self.fare_class_map,
-         self.df_tax,
-         self.df_exch,
-         self.df_atpco,
-         self.df_fod,
-         self.df_tfee_discount,
-         self.df_restricted_od) = self.read_data(data_path)
-        # Invert fare_class_map for RBD->level
-        self.inv_fare_map = {v: k for k, v in self.fare_class_map.items()}
-        # Prepare output workbook
-        self.out_wb = Workbook()
-        self.del_ws = self.out_wb.active
+#Cached property of a ReferenceData, built once under the instance's lock so that
+#preload's background thread and the run never build the same structure twice.
+#With stats, the build is timed as a read_<name> stage (see RunStats.read).
+class loaded_once:
+    def __init__(self, func):
+        self.func = func
+        self.name = func.__name__
+
+    def __get__(self, obj, owner=None):
+        if obj is None:
+            return self
+        with obj.lock:
+            if self.name not in obj.__dict__:
+                with obj.stats.read(self.name) if obj.stats else nullcontext():
+                    obj.__dict__[self.name] = self.func(obj)
+        return obj.__dict__[self.name]
+
+#Reference data from data.xlsx plus the lookup structures built from it.
+#Loaded once and shared by every input file processed with it. Each structure is built
+#from its sheet on first use, so a run only parses the sheets it gets to: ATPCO Data,
+#by far the largest, is only read once a row gets past validation.
+class ReferenceData:
+    # cache=True/'hash' reuses the parsed sheets between runs (see SheetReader);
+    # engine='calamine'/'auto' reads the workbook with python-calamine when it's installed.
+    # A RunStats passed as stats times each structure's read (see loaded_once).
+    def __init__(self, data_path, cache=False, engine=None, stats=None):
+        self.data_path = data_path
+        self.stats = stats
+        self.data_hash = None
+        self.filed_fbcs = None
+        self.sheets = SheetReader(data_path, DATA_COLUMNS, cache=cache, engine=excel_engine(engine))
+        self.lock = threading.RLock()
+
+    # Worker processes get their own lock, and don't collect stats
+    def __getstate__(self):
+        return dict(self.__dict__, lock=None, stats=None)
+
+    def __setstate__(self, state):
+        self.__dict__.update(state, lock=threading.RLock())
+
+    def sheet(self, name):
+        df = self.sheets.read(name)
+        if df is None:
+            raise ValueError(f"{self.data_path} has no '{name}' sheet")
+        return df
 
-        self.del_ws.title = 'DELETE'
+    # Everything pricing uses, in the order a run first needs it
+    LOADED = ('restricted_od', 'fare_calc_od', 'tax_table', 'exch_rates', 'fare_ladder',
+              'inv_fare_map', 'tfee_discounts', 'atpco')
+
+    # Build everything pricing uses, e.g. before forking worker processes
+    def load(self):
+        for name in self.LOADED:
+            getattr(self, name)
+        with self.lock:
+            self.sheets.close()
+
+    # Start building everything pricing uses on a background thread, while the input is read.
+    # Failures are left for the run to hit (and report) when it needs the structure.
+    # The thread doesn't keep the process alive: a run that rejects every row just ends.
+    def preload(self):
+        load_modules()
+
+        def build():
+            for name in self.LOADED:
+                try:
+                    getattr(self, name)
+                except Exception:
+                    pass
+        threading.Thread(target=build, name='preload', daemon=True).start()
+
+    @loaded_once
+    def fare_class_map(self):
+        df_fcr = self.sheet('FCR')
+        return dict(zip(df_fcr['Fare Level'], df_fcr['Fare Class']))
+
+    # Invert fare_class_map for RBD->level
+    @loaded_once
+    def inv_fare_map(self):
+        return {v: k for k, v in self.fare_class_map.items()}
+
+    @loaded_once
+    def fare_ladder(self):
+        df_ladder = self.sheets.read('Fare Ladder')
+        if df_ladder is None:
+            df_ladder = pd.DataFrame(DEFAULT_FARE_LADDER, columns=FARE_LADDER_COLUMNS)
+        return FareLadder(df_ladder)
+
+    # ATPCO rows normalised and indexed once; the sheet's frame is not kept
+    @loaded_once
+    def atpco(self):
+        return AtpcoTable(self.sheet('ATPCO Data'))
+
+    # Origin/destination sets for the Restricted OD and Fare Calc OD checks.
+    # Origin and destination are matched independently, as in the sheets.
+    @loaded_once
+    def restricted_od(self):
+        df = self.sheet('Restricted OD')
+        return text_set(df['Origin']), text_set(df['Destination'])
+
+    @property
+    def restricted_origins(self):
+        return self.restricted_od[0]
+
+    @property
+    def restricted_dests(self):
+        return self.restricted_od[1]
+
+    @loaded_once
+    def fare_calc_od(self):
+        df = self.sheet('Fare Calc OD')
+        return text_set(df['Origin']), text_set(df['Destination']), text_set(df['All Destination'])
+
+    @property
+    def fod_origins(self):
+        return self.fare_calc_od[0]
+
+    @property
+    def fod_dests(self):
+        return self.fare_calc_od[1]
+
+    @property
+    def fod_all_dests(self):
+        return self.fare_calc_od[2]
+
+    # Tax rows keyed on stripped (Origin, Destination, JourneyType), first row wins
+    @loaded_once
+    def tax_table(self):
+        df_tax = self.sheet('Tax')
+        return df_tax.assign(
+            **{col: df_tax[col].astype(object).map(strip_text)
+               for col in ('Origin', 'Destination', 'JourneyType')}
+        ).drop_duplicates(subset=['Origin', 'Destination', 'JourneyType'])[
+            ['Origin', 'Destination', 'JourneyType', 'FixedTaxTotal', 'YQ', 'YR']]
+
+    # Exchange rates keyed on the pair, e.g. 'QAR/AED', first row wins
+    @loaded_once
+    def exch_rates(self):
+        df_exch = self.sheet('Exchange Rates')
+        exch_rates = {}
+        for pair, price in zip(df_exch['Currency'], df_exch['Price']):
+            exch_rates.setdefault(pair, price)
+        return exch_rates
+
+    # Tfee discounts keyed on the stripped OD, e.g. 'DOHDXB' -> (OW, RT), first row wins
+    @loaded_once
+    def tfee_discounts(self):
+        df = self.sheet('Tfee discount')
+        tfee_discounts = {}
+        for od, ow, rt in zip(df['Ods'], df['OW'], df['RT']):
+            if isinstance(od, str):
+                tfee_discounts.setdefault(od.strip(), (ow, rt))
+        return tfee_discounts
+
+    # Stripped FareClass codes in ATPCO Data, built on first use
+    def fare_classes(self):
+        if self.filed_fbcs is None:
+            self.filed_fbcs = text_set(self.atpco.distinct('FareClass'))
+        return self.filed_fbcs
+
+    # sha256 of the data.xlsx contents, hashed on first use
+    def fingerprint(self):
+        if self.data_hash is None:
+            self.data_hash = file_fingerprint(self.data_path, content_hash=True)['sha256']
+        return self.data_hash
+
+# Bump when a change to the pricing rules makes stored PriceMemo results stale
+PRICING_VERSION = 2
+# Brands in the order their DELETE rows are written
+DELETE_BRANDS = ['Brand 1', 'Brand 2', 'Brand 3', 'GDS 1', 'GDS 2']
+
+#What price_row needs besides the row: the reference data, the SALES/TRAVEL/FN
+#header of the input sheet and the filing date written on the FILE rows
+class PricingContext:
+    def __init__(self, reference, sales, travel, fn, filing_date=None):
+        self.ref = reference
+        self.sales = sales
+        self.travel = travel
+        self.fn = fn
+        self.filing_date = filing_date or datetime.now().strftime('%d-%m-%y')
+        self.fbc_codes = fbc_codes(sales)
+        self.memo_key = None
+
+    # Everything besides the row that a priced row depends on (see PriceMemo)
+    def key(self):
+        if self.memo_key is None:
+            self.memo_key = (PRICING_VERSION, self.ref.fingerprint(),
+                             self.sales, self.travel, self.fn, self.filing_date)
+        return self.memo_key
+
+#One validated, enriched input row (see FareFilingProcessor.enrich)
+PricingRow = namedtuple('PricingRow', ['origin', 'dest', 'trip', 'rbd', 'currency', 'b1',
+                                       'tax', 'yq', 'tfee', 'exch', 'aed', 'new_rbd', 'error'])
+
+#Enriched input rows as (index, PricingRow) pairs
+def pricing_rows(df):
+    columns = [df[col].tolist() for col in ('O', 'D', 'O/R', 'RBD', 'CURRENCY', 'B1', 'TAX', 'YQ', 'YR',
+                                            'EXCH', 'AED', 'NEW_RBD', 'ENRICH_ERROR')]
+    return [(idx, PricingRow(*values)) for idx, values in zip(df.index, zip(*columns))]
+
+#Input values a priced row depends on; the rest of a PricingRow is derived from them and data.xlsx
+def row_key(row):
+    return (row.origin, row.dest, row.trip, row.rbd, row.currency, row.b1)
+
+#Outcome of pricing one row: its COMPLETED status, the rows it adds to the DELETE and FILE
+#sheets and its GH amendments, (ATPCO row position, Brand fare, currency, trip) tuples
+#written to the GH sheet in one batch (see gh_rows)
+class RowResult:
+    __slots__ = ('completed', 'delete', 'file', 'gh')
+
+    def __init__(self, completed=''):
+        self.completed = completed
+        self.delete = []
+        self.file = []
+        self.gh = []
+
+    # Append to the COMPLETED status
+    def note(self, text):
+        self.completed = (self.completed + text).strip()
+
+# Baggage code in the FBC for the usual allowances; anything above 40 is 'NF'
+BAG_CODES = {20: 'B', 30: 'L', 40: 'X'}
+
+def get_baggage_code(bag):
+    code = BAG_CODES.get(bag)
+    if code is None and bag > 40:
+        return "NF"
+    return code
+
+# FBC brand codes, for STRUCTURE sales and for the rest
+FBC_BRAND_CODES = {
+    True: {'Brand 1': '6', 'Brand 2': '7', 'GDS 1': '7', 'Brand 3': '7', 'GDS 2': '3'},
+    False: {'Brand 1': '6', 'Brand 2': '7', 'Brand 3': '8', 'GDS 1': 'P7', 'GDS 2': 'P3'},
+}
+# Origin country in the FBC, 'SA' for any other origin
+FBC_COUNTRIES = {'BAH': 'BH', 'KWI': 'KW', 'DOH': 'QA', 'MCT': 'OM', 'SLL': 'OM'}
+
+#Brand code and channel type digit of every brand for a SALES value, worked out once
+#per input sheet: {brand: (code, type)}
+def fbc_codes(sales):
+    structure = str(sales).strip().upper() == 'STRUCTURE'
+    codes = {}
+    for brand, channel in BRAND_CHANNELS.items():
+        type = '2' if channel == 'WEB' and structure else ('5' if channel == 'WEB' else '1')
+        codes[brand] = (FBC_BRAND_CODES[structure][brand], type)
+    return codes
+
+#The part of a row's FBCs after the RBD, per brand: trip, baggage, brand code, origin
+#country, channel type and FN. An FBC is then origin + destination + RBD + this.
+def fbc_suffixes(ctx, row, bag_codes):
+    trip_code = 'O' if row.trip == 1 else 'R'
+    o_country = FBC_COUNTRIES.get(row.origin, 'SA')
+    return {brand: f"{trip_code}{bag_codes[brand]}{code}{o_country}{type}-{ctx.fn}"
+            for brand, (code, type) in ctx.fbc_codes.items()}
+
+#ATPCO row as written to the DELETE and GH sheets, with the given amount
+def atpco_out(atpco, amount):
+    return [atpco['Tariff'], atpco['CXR'], atpco['NAT1'], atpco['NAT2'],
+            atpco['LOC1'], atpco['LOC2'], atpco['Rule'], atpco['FareClass'],
+            atpco['OW/RT'], atpco['RTG'], atpco['FN'], atpco['CUR'], amount,
+            atpco.eff_date(), atpco['Disc.Date'], atpco['GFSFAN']]
+
+#Baggage per brand for the row's RBD, 0 where ATPCO has no row.
+#Structure RBDs (level above 8) are matched on any FN.
+def row_baggage(ctx, row, level):
+    ref = ctx.ref
+    bags = {}
+    for brand in BRAND_CHANNELS:
+        if level > 8:
+            pos = ref.atpco.find_any_fn(row.origin, row.dest, row.rbd, brand, row.trip)
+        else:
+            pos = ref.atpco.find(row.origin, row.dest, row.rbd, brand, ctx.fn, row.trip)
+        bags[brand] = ref.atpco.value(pos, 'BAG') if pos is not None else 0
+    return bags
+
+# Brands whose GH fares are amended after a filing
+GH_BRANDS = ('Brand 1', 'Brand 2', 'Brand 3')
+
+# What a row's walk from its filed level to its new one does, worked out up front:
+# the levels filed as NEW (new level last), the levels whose fares are deleted and the
+# level amended (None when there is none)
+Cascade = namedtuple('Cascade', ['build', 'delete', 'amend'])
+
+#Plan the level cascade of a row. Going down builds every level to the new one; going
+#up deletes every level below the new one (structure levels above 8 have nothing to
+#delete) and amends the new one; staying re-files the level as an AMEND.
+def plan_cascade(filed_level, new_level):
+    if filed_level == new_level:
+        return Cascade([], [], filed_level)
+    if filed_level > new_level:
+        return Cascade(list(range(filed_level - 1, new_level - 1, -1)), [], None)
+    return Cascade([], [level for level in range(filed_level, new_level) if level <= 8], new_level)
+
+#ATPCO rows a cascade can read for one input row (its OD, FN and trip), fetched in one
+#grouped lookup: every brand of the deleted and amended levels, plus its GH rows
+class RowAtpco:
+    def __init__(self, ctx, row, plan):
+        ref = ctx.ref
+        keys = [(ref.fare_class_map[level], brand) for level in plan.delete for brand in DELETE_BRANDS]
+        if plan.amend is not None:
+            keys += [(ref.fare_class_map[plan.amend], brand) for brand in BRAND_CHANNELS]
+        self.table = ref.atpco
+        self.found = dict(zip(keys, self.table.find_many(row.origin, row.dest, ctx.fn, row.trip, keys)))
+        self.gh = self.table.find_gh(row.origin, row.dest, ctx.fn, row.trip)
+
+    # ATPCO row for the RBD and brand, or None
+    def get(self, rbd, brand):
+        pos = self.found[(rbd, brand)]
+        return None if pos is None else self.table.row(pos)
+
+#Price the brand ladder at one or more fare levels from their Brand 1 fares, as one batch,
+#and add five FILE rows per level in the order of the levels. An AMEND (one level) chains
+#the filed fares and bumps any fare ATPCO already has (see price_brands).
+#Returns the fares of the last level.
+def file_brands(ctx, row, bags, atpco, action, levels, b1_bases, b1_totals, result):
+    ref = ctx.ref
+    rbds = [ref.fare_class_map[level] for level in levels]
+    filed_base = None
+    if action == 'AMEND':
+        filed_base = {}
+        for brand in BRAND_CHANNELS:
+            filed = atpco.get(rbds[0], brand)
+            filed_base[brand] = np.nan if filed is None else filed['BASE FARE']
+    fares = price_brands(b1_bases, b1_totals, row.exch, row.tax, row.yq, row.tfee, row.trip, levels,
+                         row.origin in ref.fod_origins and row.dest in ref.fod_dests,
+                         chain=action == 'AMEND', filed_base=filed_base)
+    bag_codes = {brand: "" if brand == 'Brand 1' else get_baggage_code(bags[brand]) for brand in BRAND_CHANNELS}
+    suffixes = fbc_suffixes(ctx, row, bag_codes)
+    bases = {brand: fares[brand].base.tolist() for brand in BRAND_CHANNELS}
+    totals = {brand: fares[brand].total.tolist() for brand in BRAND_CHANNELS}
+    for i, rbd in enumerate(rbds):
+        od_rbd = f"{row.origin}{row.dest}{rbd}"
+        for brand, channel in BRAND_CHANNELS.items():
+            fbc = od_rbd + suffixes[brand]
+            result.file.append([action, row.origin, row.dest, rbd, channel, row.trip,
+                                bags[brand], brand, int(bases[brand][i]), row.currency,
+                                ctx.sales, ctx.travel, '', ctx.fn, ctx.filing_date,
+                                int(totals[brand][i]), fbc, ''])
+    return {brand: BrandFares(*(values[-1] for values in fares[brand])) for brand in BRAND_CHANNELS}
+
+#Brand 1 fare of a level below the row's own one, from the fare ladder's fare for its RBD
+def ladder_fare(ctx, row, level):
+    b1_base = (ctx.ref.fare_ladder.b1_fare(ctx.ref.fare_class_map[level], row.trip)/row.exch) - row.yq
+    return b1_base, b1_base + row.tax + row.yq
+
+#Delete the ATPCO fares of every brand at a level
+def delete_level(ctx, row, atpco, level, result):
+    for brand in DELETE_BRANDS:
+        filed = atpco.get(ctx.ref.fare_class_map[level], brand)
+        if filed is not None:
+            result.delete.append(atpco_out(filed, filed['Amount']))
+
+#Amend the GH fares of Brands 1-3 from the fares just filed (see gh_rows)
+def file_gh(ctx, row, atpco, fares, result):
+    for brand in GH_BRANDS:
+        pos = atpco.gh.get(brand)
+        if pos is not None:
+            result.gh.append((pos, fares[brand].ladder_base.item(), row.currency, row.trip))
+
+#GH FARE AMENDMENT rows for a batch of GH amendments (see RowResult), in order: the GH
+#fare goes up by 20 (one-way) or 40 (return) in QAR and SAR, 2 or 4 otherwise, and is
+#rounded up when it isn't whole
+def gh_rows(atpco, amendments):
+    if not amendments:
+        return []
+    positions, fares, currencies, trips = zip(*amendments)
+    one_way = np.asarray(trips) == 1
+    increment = np.where(np.isin(np.asarray(currencies, dtype=object), ['QAR', 'SAR']),
+                         np.where(one_way, 20, 40), np.where(one_way, 2, 4))
+    amounts = np.asarray(fares, dtype=float) + increment
+    whole = (amounts == np.trunc(amounts)).tolist()
+    rounded = np.floor(amounts + 1).astype(np.int64).tolist()
+    return [["Amend Fare"] + atpco_out(atpco.row(pos), amount if is_whole else up)
+            for pos, amount, is_whole, up in zip(positions, amounts.tolist(), whole, rounded)]
+
+#Re-file a level from the given Brand 1 fare, unless ATPCO has no Brand 1 fare there
+#or already files this one
+def amend_level(ctx, row, bags, atpco, level, b1_base, b1_total, result):
+    if(level>8):
+        return
+    # Check current base fare in ATPCO
+    filed = atpco.get(ctx.ref.fare_class_map[level], 'Brand 1')
+    if filed is None:
+        return
+    if (filed['BASE FARE'] - b1_base) == 0:
+        result.note('//Not amended as same fare')
+        return
+    fares = file_brands(ctx, row, bags, atpco, 'AMEND', [level], [b1_base], [b1_total], result)
+    result.completed = 'YES'
+    file_gh(ctx, row, atpco, fares, result)
+
+#Price one validated, enriched input row. Reads only the context and the row,
+#so rows can be priced in any order, in other processes or from a cache.
+#The level cascade is planned first (see plan_cascade) and its ATPCO rows fetched at once.
+def price_row(ctx, row):
+    ref = ctx.ref
+    result = RowResult()
+    filed_level = ref.inv_fare_map[row.rbd]
+    bags = row_baggage(ctx, row, filed_level)
+    # Check if baggage data is available in the ATPCO
+    if any(bag == 0 for bag in bags.values()):
+        result.completed = 'Missing ATPCO data'
+        return result
+    #Check if the tax row or exchange rate is missing
+    if row.error:
+        result.completed = row.error
+        return result
+
+    #Base fare with yq in AED gives the fare level
+    b1_base = row.b1 - row.tax - row.yq
+    if(row.aed<50):
+        result.completed = 'Incorrect B1 total fare'
+        return result
+    new_level = ref.inv_fare_map[row.new_rbd]
+
+    #Calculate tfee discount
+    if(filed_level <=5):
+        discount = ref.tfee_discounts.get(row.origin + row.dest)
+        if discount is not None:
+            row = row._replace(tfee=discount[0] if row.trip == 1 else discount[1])
+        if pd.isna(row.tfee):
+            result.completed = 'Missing TFEE data in Fare Calc OD sheet'
+            return result
+
+    filed_level = min(filed_level, 9)
+    plan = plan_cascade(filed_level, new_level)
+    atpco = RowAtpco(ctx, row, plan)
+    if (filed_level == new_level):
+        amend_level(ctx, row, bags, atpco, filed_level, b1_base, row.b1, result)
+    elif (filed_level > new_level):
+        # Build each level down to the new one from the fare ladder, then file the row's own fare there
+        ladder = [ladder_fare(ctx, row, level) for level in plan.build[:-1]]
+        fares = file_brands(ctx, row, bags, atpco, 'NEW', plan.build,
+                            [base for base, _ in ladder] + [b1_base],
+                            [total for _, total in ladder] + [row.b1], result)
+        file_gh(ctx, row, atpco, fares, result)
+        result.note(' YES')
+        filed_level = new_level
+    else:
+        # Delete each level up to the new one, then amend the row's fare there,
+        # bumped when it is within 1 of the Brand 1 fare ATPCO already has
+        for level in plan.delete:
+            delete_level(ctx, row, atpco, level, result)
+        b1_total = row.b1
+        filed_row = atpco.get(ref.fare_class_map[new_level], 'Brand 1')
+        if filed_row is not None and -1 <= (filed_row['BASE FARE'] - b1_base) <= 1:
+            bump = 10 if row.currency in ("SAR", "QAR") else 1
+            b1_base += bump
+            b1_total += bump
+        result.note(' YES')
+        amend_level(ctx, row, bags, atpco, new_level, b1_base, b1_total, result)
+        # The walk up stops one level past the new one
+        filed_level = new_level + 1
+    if(filed_level>8 or new_level>8):
+        result.note('//Structure RBD')
+    return result
+
+#The DELETE, FILE and GH FARE AMENDMENT sheets of an output workbook.
+#write_only=True streams the sheets to disk as rows are added (flat memory, fast save).
+#DUPE CHECK is filled as each FILE row is added (see dupe_check); check_atpco=True also
+#checks NEW rows against the FareClass codes live in the reference's ATPCO Data.
+#GH amendments are collected and written in one batch by write_gh, at the latest on save.
+class OutputWorkbook:
+    def __init__(self, reference, write_only=False, check_atpco=False):
+        self.ref = reference
+        self.out_wb = openpyxl.Workbook(write_only=write_only)
+        self.dupe_fill = openpyxl.styles.PatternFill(start_color=DUPE_COLOR, end_color=DUPE_COLOR, fill_type='solid')
+        if write_only:
+            self.del_ws = self.out_wb.create_sheet('DELETE')
+        else:
+            self.del_ws = self.out_wb.active
+            self.del_ws.title = 'DELETE'
         self.del_ws.append(["Tariff","CXR","NAT1","NAT2","LOC1","LOC2","Rule",
                              "FareClass","OW/RT","RTG","FN","CUR","Amount",
                              "Eff.Date","Disc.Date","GFSFAN"])
@@ -79,9 +1102,241 @@ class FareFilingProcessor:
         self.gh_ws.append(["ACTION","Tariff","CXR","NAT1","NAT2","LOC1","LOC2","Rule",
                              "FareClass","OW/RT","RTG","FN","CUR","New Amount",
                              "Eff.Date","Disc.Date","GFSFAN"])
+        # FBCs written to the FILE sheet so far, for the duplicate check
+        self.seen_fbcs = set()
+        self.check_atpco = check_atpco
+        self.gh_pending = []
+        # Rows written: DELETE and GH rows, FILE rows by action and FILE rows flagged by dupe_check
+        self.counts = Counter()
+
+    # Append a priced row's DELETE, FILE and GH rows
+    def add(self, result):
+        for out in result.delete:
+            self.del_ws.append(out)
+        for out in result.file:
+            self.append_file_row(out)
+            self.counts[out[0]] += 1
+        self.gh_pending.extend(result.gh)
+        self.counts['DEL'] += len(result.delete)
+        self.counts['GH'] += len(result.gh)
+
+    # Append a FILE row with its DUPE CHECK value; a flagged FBC cell is highlighted
+    def append_file_row(self, row):
+        row = list(row)
+        row[17] = self.dupe_check(row[0], row[16])
+        if row[17] != 'OK':
+            self.counts[row[17]] += 1
+            row[16] = openpyxl.cell.WriteOnlyCell(self.file_ws, value=row[16])
+            row[16].fill = self.dupe_fill
+        self.file_ws.append(row)
+
+    # DUPE CHECK value for the FILE row being added: 'Not OK' when an earlier row has the
+    # same FBC, 'In ATPCO' when a NEW row's FBC is already filed (with check_atpco), else 'OK'
+    def dupe_check(self, action, fbc):
+        if fbc in self.seen_fbcs:
+            return 'Not OK'
+        self.seen_fbcs.add(fbc)
+        if self.check_atpco and action == 'NEW' and fbc in self.ref.fare_classes():
+            return 'In ATPCO'
+        return 'OK'
+
+    # Write the GH amendments added so far
+    def write_gh(self):
+        for out in gh_rows(self.ref.atpco, self.gh_pending) if self.gh_pending else []:
+            self.gh_ws.append(out)
+        self.gh_pending = []
+
+    def save(self, path):
+        self.write_gh()
+        self.out_wb.save(path)
+
+#Calls write with each queued item on a thread of its own. The queue is bounded, so
+#pricing runs at most size items ahead of writing. An error raised by write stops the
+#writing and is raised again by the next put or by close.
+class ThreadedWriter:
+    def __init__(self, write, size=256):
+        self.queue = queue.Queue(size)
+        self.error = None
+        self.thread = threading.Thread(target=self.run, args=(write,), name='writer', daemon=True)
+        self.thread.start()
+
+    def run(self, write):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            if self.error is None:
+                try:
+                    write(*item)
+                except BaseException as e:
+                    self.error = e
+
+    def put(self, *item):
+        if self.error is not None:
+            raise self.error
+        self.queue.put(item)
+
+    # Wait for the queued items to be written
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+#Where the input table with its COMPLETED column is written back after a run, and read
+#back from by incremental runs. 'source' replaces the Processed sheet of the input workbook
+#(falling back to csv when it can't be written, e.g. a read-only share); 'csv', 'xlsx' and
+#'parquet' write <input name>_processed.<ext> next to the output; 'none' skips it.
+class StatusSink:
+    def __init__(self, kind, input_path, output_path):
+        if kind == 'parquet' and importlib.util.find_spec('pyarrow') is None:
+            print("pyarrow is not installed, writing the status as csv")
+            kind = 'csv'
+        self.kind = kind
+        self.input_path = input_path
+        self.output_dir = os.path.dirname(output_path)
+        self.path = input_path if kind in ('source', 'none') else self.sidecar_path(kind)
+
+    def sidecar_path(self, kind):
+        name = os.path.splitext(os.path.basename(self.input_path))[0]
+        return os.path.join(self.output_dir, f"{name}_processed.{kind}")
+
+    def write(self, df):
+        if self.kind == 'source':
+            try:
+                with pd.ExcelWriter(self.input_path,
+                                    engine='openpyxl',
+                                    mode='a',
+                                    if_sheet_exists='replace') as writer:
+                                        # overwrite the “Processed” sheet if it already exists
+                                        df.to_excel(writer, sheet_name='Processed', index=False)
+                return
+            except OSError:
+                self.kind, self.path = 'csv', self.sidecar_path('csv')
+                print(f"Could not write to {self.input_path}, status written to {self.path}")
+        if self.kind == 'csv':
+            df.to_csv(self.path, index=False)
+        elif self.kind == 'xlsx':
+            df.to_excel(self.path, sheet_name='Processed', index=False)
+        elif self.kind == 'parquet':
+            # Parquet columns hold one type: write mixed text/number columns as text
+            mixed = [col for col in df.columns if df[col].dtype == object and df[col].map(type).nunique() > 1]
+            df.astype({col: str for col in mixed}).to_parquet(self.path, index=False)
+
+    # Table the last run wrote, or None
+    def read(self):
+        try:
+            if self.kind == 'source':
+                return pd.read_excel(self.input_path, sheet_name='Processed')
+            if self.kind == 'csv':
+                return pd.read_csv(self.path)
+            if self.kind == 'xlsx':
+                return pd.read_excel(self.path, sheet_name='Processed')
+            if self.kind == 'parquet':
+                return pd.read_parquet(self.path)
+        except (OSError, ValueError):
+            pass
+        return None
+
+#State of incremental runs, kept in a folder next to the input (e.g. input.xlsx.state/):
+#a PriceMemo store of the priced rows, and the context the last run was priced in
+class RefileState:
+    def __init__(self, input_path):
+        self.dir = input_path + '.state'
+        self.memo = PriceMemo(path=self.dir)
+        self.snapshot_path = os.path.join(self.dir, 'snapshot.json')
+
+    # context_id of the last run, or None
+    def last_context(self):
+        try:
+            with open(self.snapshot_path) as f:
+                return json.load(f).get('context')
+        except (OSError, ValueError):
+            return None
+
+    # Record the run's context and delete the stores of every other context: a run with
+    # a new context reprices every row, so only the last one's store is ever reused
+    def save(self, context):
+        try:
+            os.makedirs(self.dir, exist_ok=True)
+            with open(self.snapshot_path, 'w') as f:
+                json.dump({'context': context_id(context.key())}, f)
+        except OSError:
+            return
+        keep = os.path.basename(self.memo.store_path(context.key()))
+        for name in os.listdir(self.dir):
+            if name.endswith(('.pkl', '.pkl.tmp')) and name != keep:
+                try:
+                    os.remove(os.path.join(self.dir, name))
+                except OSError:
+                    pass
+
+class FareFilingProcessor:
+    # Pass a loaded ReferenceData as reference to reuse it across input files;
+    # otherwise data_path is read with the cache and engine options (see ReferenceData).
+    # output_path defaults to output/output.xlsx.
+    # write_only=True streams the output sheets to disk (see OutputWorkbook).
+    # interactive=False never waits for input: a locked workbook raises FileLockedError.
+    # A PriceMemo passed as memo reuses results for rows it has already priced.
+    # incremental=True reprices only rows that are new or changed since the last run
+    # (see changed_rows) and also writes them alone to a delta workbook, <output>_delta.xlsx.
+    # status picks where the table with COMPLETED is written back (see StatusSink).
+    # A RunStats passed as stats collects the run's stage timings and counters.
+    # check_atpco=True also flags NEW rows whose FBC is already a FareClass in ATPCO Data.
+    # pipeline=True overlaps the stages of a run on threads: data.xlsx is parsed while the
+    # input is read (see ReferenceData.preload), rows are written while the next ones are
+    # priced (see ThreadedWriter) and the status is written while the output is saved.
+    def __init__(self, input_path, data_path=None, write_only=False, cache=False, engine=None,
+                 reference=None, output_path=None, interactive=True, memo=None, incremental=False,
+                 status='source', stats=None, check_atpco=False, pipeline=False):
+        input_path = resolve_path_input(input_path)
+        self.input_path = input_path
+        self.output_path = output_path or resolve_path_output('output.xlsx')
+        # The output folder is made up front, so a missing one doesn't fail the run after pricing
+        os.makedirs(os.path.dirname(os.path.abspath(self.output_path)), exist_ok=True)
+        self.interactive = interactive
+        self.memo = memo
+        self.engine = excel_engine(engine)
+        self.status = StatusSink(status, input_path, self.output_path)
+        self.stats = stats
+        self.pipeline = pipeline
+        self.writer = None
+
+        # Read  data sheet
+        if reference is None:
+            with self.stage('read_data'):
+                reference = ReferenceData(resolve_path_input(data_path), cache=cache, engine=engine,
+                                          stats=stats)
+            if pipeline:
+                reference.preload()
+        self.ref = reference
+        # Read input data
+        with self.stage('read_input'):
+            self.df_table, self.sales, self.travel, self.fn = self.read_input(input_path)
+        self.context = PricingContext(self.ref, self.sales, self.travel, self.fn)
+        # Prepare output workbook
+        self.output = OutputWorkbook(self.ref, write_only, check_atpco)
+        # Incremental runs: last run's input rows, and the delta workbook
+        self.state = None
+        if incremental:
+            self.state = RefileState(input_path)
+            if memo is None or not memo.path:
+                self.memo = self.state.memo
+            self.snapshot = self.read_snapshot()
+            self.delta = OutputWorkbook(self.ref, write_only=True, check_atpco=check_atpco)
+
+    # Timer for a named stage when stats are collected
+    def stage(self, name):
+        return self.stats.stage(name) if self.stats else nullcontext()
+
+    # Ask the user to close a locked workbook (interactive runs), then stop
+    def file_locked(self, path, message):
+        if self.interactive:
+            input(message)
+        raise FileLockedError(path)
 
     def read_input(self, input_path):
-        df_raw = pd.read_excel(input_path, header=None)
+        df_raw = pd.read_excel(input_path, header=None, engine=self.engine)
         # SALES row
         sales_row = df_raw[df_raw[0].astype(str).str.strip().str.upper() == 'SALES'].index[0]
         sales = df_raw.iloc[sales_row + 1, 0]
@@ -98,732 +1353,468 @@ class FareFilingProcessor:
         df_table.insert(idx, 'COMPLETED', '')
         return df_table, sales, travel, fn
  
-    def read_data(self, data_path):
-        xls = pd.ExcelFile(data_path)
-        df_fcr = pd.read_excel(xls, 'FCR')
-        df_tax = pd.read_excel(xls, 'Tax')
-        df_exch = pd.read_excel(xls, 'Exchange Rates')
-        df_atpco = pd.read_excel(xls, 'ATPCO Data')
-        df_fod = pd.read_excel(xls, 'Fare Calc OD')
-        fare_class_map = dict(zip(df_fcr['Fare Level'], df_fcr['Fare Class']))
-        df_tfee_discount = pd.read_excel(xls, 'Tfee discount')
-        df_restricted_od = pd.read_excel(xls, 'Restricted OD')
-        return fare_class_map, df_tax, df_exch, df_atpco, df_fod, df_tfee_discount, df_restricted_od
-    
-    def get_exchange_rate(self, currency):
-        # currency is e.g. 'QAR'; lookup 'QAR/AED' in the sheet
-        curr = str(currency).strip()
-        pair = f"{curr}/AED"
-        rates = self.df_exch[self.df_exch['Currency'] == pair]
-        if rates.empty:
-            raise ValueError(f"No exchange rate found for pair {pair}")
-        return rates.iloc[0]['Price']
-
-    def translate_loc(self, code):
-        return CODE_MAP.get(code, code)
-
-    def baggage_structure(self, origin, dest, rbd, brand, trip):
-        df = self.df_atpco[
-            (self.df_atpco['LOC1'].str.strip() == self.translate_loc(origin)) &
-            (self.df_atpco['LOC2'].str.strip() == self.translate_loc(dest)) &
-            (self.df_atpco['RBD'].str.strip() == rbd) &
-            (self.df_atpco['BRAND'].str.strip() == brand) &
-            (self.df_atpco['OW/RT'] == trip)
-        ]
-        return (df['BAG'].values[0]) if not df.empty else 0
-    
-    def baggage_non_structure(self, origin, dest, rbd, brand, fn, trip):
-        df = self.df_atpco[
-            (self.df_atpco['LOC1'].str.strip() == self.translate_loc(origin)) &
-            (self.df_atpco['LOC2'].str.strip() == self.translate_loc(dest)) &
-            (self.df_atpco['RBD'].str.strip() == rbd) &
-            (self.df_atpco['BRAND'].str.strip() == brand) &
-            (self.df_atpco['FN'].str.strip() == fn) &
-            (self.df_atpco['OW/RT'] == trip)
+    # Join the rows to price against the tax table and exchange rates in one pass.
+    # Adds TAX/YQ/YR/EXCH, the AED fare and its new RBD, and an ENRICH_ERROR reason for rows that
+    # can't be priced, instead of failing the whole run on the first bad row.
+    def enrich(self, df):
+        keys = pd.DataFrame({'Origin': df['O'].astype(object).to_numpy(),
+                             'Destination': df['D'].astype(object).to_numpy(),
+                             'JourneyType': df['O/R'].map({1: 'OW', 2: 'RT'}).astype(object).to_numpy()})
+        tax = keys.merge(self.ref.tax_table, how='left', on=['Origin', 'Destination', 'JourneyType'])
+        pairs = df['CURRENCY'].map(lambda curr: f"{str(curr).strip()}/AED")
+        out = df.copy()
+        out['TAX'] = tax['FixedTaxTotal'].to_numpy()
+        out['YQ'] = tax['YQ'].to_numpy()
+        out['YR'] = tax['YR'].to_numpy()
+        out['EXCH'] = pairs.map(self.ref.exch_rates).astype(float)
+        missing_tax = out[['TAX', 'YQ', 'YR']].isna().any(axis=1)
+        missing_rate = out['EXCH'].isna()
+        # B1 base fare with YQ in AED, and the RBD it files in
+        out['AED'] = np.trunc((df['B1'].astype(float) - out['TAX']) * out['EXCH'])
+        out['NEW_RBD'] = self.ref.fare_ladder.rbds_for(out['AED'], df['O/R'])
+        out['ENRICH_ERROR'] = np.select([missing_tax.to_numpy(), missing_rate.to_numpy()],
+                                        ['Missing Tax data', 'Missing exchange rate for ' + pairs.astype(str)],
+                                        default='')
+        return out
+
+    # Input values (see row_key) of the rows the last run wrote back (see StatusSink), or None.
+    # Trip and B1 are read as numbers, as text sidecars may hold them as text.
+    def read_snapshot(self):
+        df = self.status.read()
+        if df is None or not {'O', 'D', 'O/R', 'RBD', 'CURRENCY', 'B1'}.issubset(df.columns):
+            return None
+        trip, b1 = (pd.to_numeric(df[col], errors='coerce') for col in ('O/R', 'B1'))
+        return set(zip(df['O'].tolist(), df['D'].tolist(), trip.tolist(), df['RBD'].tolist(),
+                       df['CURRENCY'].tolist(), b1.tolist()))
+
+    # Indexes of the rows to price that the last run didn't have. Every row counts as changed
+    # when there is no last run, or data.xlsx, the input header or the filing date changed since.
+    def changed_rows(self, rows):
+        if self.snapshot is None or self.state.last_context() != context_id(self.context.key()):
+            return {idx for idx, _ in rows}
+        return {idx for idx, row in rows if row_key(row) not in self.snapshot}
+
+    # Run the input checks over whole columns, write the rejection reasons
+    # into COMPLETED in one go and return the mask of rows left to price.
+    # Checks are listed in priority order: a row gets the first reason it fails.
+    def validate(self):
+        df = self.df_table
+        origin, dest, trip, rbd, currency, b1 = (df[col] for col in ('O', 'D', 'O/R', 'RBD', 'CURRENCY', 'B1'))
+        checks = [
+            (dest.isna() | trip.isna() | rbd.isna() | currency.isna() | b1.isna(),
+             'Missing input data'),
+            (~b1.map(type).isin([int, float]),
+             'Incorrect B1 fare in input sheet'),
+            (origin.isin(self.ref.restricted_origins) & dest.isin(self.ref.restricted_dests),
+             'Restricted OD'),
+            (~(origin.isin(self.ref.fod_origins) | ((origin == "SLL") & bool(self.ref.fod_origins))),
+             'Incorrect origin in input sheet'),
+            (~dest.isin(self.ref.fod_all_dests),
+             'Incorrect destination in input sheet'),
+            (~trip.isin([1, 2]),
+             'Incorrect trip type in input sheet'),
+            (~((rbd.map(type) == str) & (rbd.astype(str).str.len() == 1)),
+             'Incorrect RBD in input sheet'),
+            (~currency.isin(CURRENCIES),
+             'Incorrect currency in input sheet'),
         ]
-        return (df['BAG'].values[0]) if not df.empty else 0
-
-    def get_new_rbd(self, amount, trip):
-        amount = int(amount)
-        if trip == 1:
-            thresholds = [
-                (50,389,'L'),(390,454,'Q'),(455,532,'H'),(533,623,'K'),
-                (624,714,'U'),(715,831,'B'),(832,987,'R'),(988,1182,'N'),
-                (1183,1377,'M'),(1378,1637,'T'),(1638,1962,'W'),(1963,2352,'O'),
-                (2353,2807,'E'),(2808,3262,'I'),(3263,3782,'A'),(3783,999999999999999,'Y') 
-            ]
-        
-        elif trip == 2:
-            thresholds = [
-                (100,599,'L'),(600,699,'Q'),(700,819,'H'),(820,959,'K'),
-                (960,1099,'U'),(1100,1279,'B'),(1280,1519,'R'),(1520,1819,'N'),
-                (1820,2119,'M'),(2120,2519,'T'),(2520,3019,'W'),(3020,3619,'O'),
-                (3620,4319,'E'),(4320,5019,'I'),(5020,5819,'A'),(5820,999999999999999,'Y')
-            ]
-    
-        for low, high, rbd in thresholds:
-            if low <= amount <= high:
-                return rbd
-
-    def get_baggage_code(self,bag):
-        if(bag==20):
-            return "B"
-        elif(bag==30):
-            return "L"
-        elif(bag==40):
-            return "X"
-        elif(bag>40):
-            return "NF"
-
-    def fbc_calc(self, origin, destination, trip, brand, channel, sales, fn, rbd, bag_code):
-        trip_code = 'O' if trip == 1 else 'R'
-        sales_u = str(sales).strip().upper()
-        # Brand code
-        if sales_u == 'STRUCTURE':
-            if brand == 'Brand 1': code = '6'
-            elif brand in ('Brand 2', 'GDS 1'): code = '7'
-            elif brand == 'Brand 3': code = '7'
-            elif brand == 'GDS 2': code = '3'
-        else:
-            if brand == 'Brand 1': code = '6'
-            elif brand == 'Brand 2': code = '7'
-            elif brand == 'Brand 3': code = '8'
-            elif brand == 'GDS 1': code = 'P7'
-            elif brand == 'GDS 2': code = 'P3'
-        # Origin country
-        country_map = {'BAH':'BH','KWI':'KW','DOH':'QA','MCT':'OM','SLL':'OM'}
-        o_country = country_map.get(origin, 'SA')
-        # Type
-        type = '2' if channel == 'WEB' and sales_u == 'STRUCTURE' else ('5' if channel == 'WEB' else '1')
-        return f"{origin}{destination}{rbd}{trip_code}{bag_code}{code}{o_country}{type}-{fn}"
-
-    def write_file(self, action, origin, dest, rbd, channel, trip,
-                   baggage, brand, base_fare, currency,
-                   total_fare, fbc, notes=''):
-
-        self.base_fare = base_fare
-        self.total_fare = total_fare
-
-        if(base_fare != int(base_fare)):
-            self.base_fare = round_nearest(base_fare)
-        
-        if(total_fare != int(total_fare)):
-            self.total_fare = round_nearest(total_fare)
-        
-        if(self.action == "AMEND"):
-            self.base_fare,self.total_fare = self.amend_same_fare(brand, self.base_fare, self.total_fare)
-
-        row = [action, origin, dest, rbd, channel, trip,
-               baggage, brand, self.base_fare, currency,
-               self.sales, self.travel, notes, self.fn,
-               datetime.now().strftime('%d-%m-%y'),
-               self.total_fare, fbc, '']
-        self.file_ws.append(row)
-
-    def write_del(self, origin, dest, rbd, brand, trip):
-        df = self.df_atpco[
-            (self.df_atpco['LOC1'].str.strip() == self.translate_loc(origin)) &
-            (self.df_atpco['LOC2'].str.strip() == self.translate_loc(dest)) &
-            (self.df_atpco['RBD'].str.strip() == rbd) &
-            (self.df_atpco['BRAND'].str.strip() == brand) &
-            (self.df_atpco['FN'].str.strip() == self.fn) &
-            (self.df_atpco['OW/RT'] == trip)
-        ]
-        if not df.empty:
-            row = df.iloc[0]
-            out = [row['Tariff'], row['CXR'], row['NAT1'], row['NAT2'],
-                   row['LOC1'], row['LOC2'], row['Rule'], row['FareClass'],
-                   row['OW/RT'], row['RTG'], row['FN'], row['CUR'], row['Amount'],
-                   row['Eff.Date'].strftime("%d/%m/%y"), row['Disc.Date'], row['GFSFAN']]
-            self.del_ws.append(out)
-
-    def amend_same_fare(self, brand, base_fare, total_fare):
-        df = self.df_atpco[
-            (self.df_atpco['LOC1'] == self.translate_loc(self.origin)) &
-            (self.df_atpco['LOC2'] == self.translate_loc(self.dest)) &
-            (self.df_atpco['RBD'] == self.fare_class_map[self.filed_level]) &
-            (self.df_atpco['BRAND'] == brand) &
-            (self.df_atpco['FN'] == self.fn) &
-            (self.df_atpco['OW/RT'] == self.trip)
-        ]
-        
-        # print(base_fare, total_fare, "Before the condition") 
-        if(not df['BASE FARE'].empty and (df['BASE FARE'].item() - base_fare)==0):
-            
-            base_fare+=1; total_fare+=1
-            
-            # print(base_fare, total_fare, "After the condition in BF", df['BASE FARE'].item())
-
-        elif(not df['TOTAL FARE'].empty and (df['BASE FARE'].item() - base_fare)==0):
-            
-            base_fare+=1
-            total_fare+=1
-            # print(base_fare, total_fare,"After the condition in TF", df['BASE FARE'].item())
-
-        return base_fare, total_fare
-
-    def brand1_calc(self):
-        brand = 'Brand 1'; channel = 'WEB'
-        self.filed_rbd = self.fare_class_map[self.filed_level]
-        if(self.trip == 1):
-            if(self.filed_rbd == "L"):
-                self.b1_base_fare_with_yq_aed = 325
-            elif(self.filed_rbd == "Q"):
-                self.b1_base_fare_with_yq_aed = 390
-            elif(self.filed_rbd == "H"):
-                self.b1_base_fare_with_yq_aed = 455
-            elif(self.filed_rbd == "K"):
-                self.b1_base_fare_with_yq_aed = 533
-            elif(self.filed_rbd == "U"):
-                self.b1_base_fare_with_yq_aed = 624
-            elif(self.filed_rbd == "B"):
-                self.b1_base_fare_with_yq_aed = 715
-            elif(self.filed_rbd == "R"):
-                self.b1_base_fare_with_yq_aed = 832
-            elif(self.filed_rbd == "N"):
-                self.b1_base_fare_with_yq_aed = 988
-            elif(self.filed_rbd == "M"):
-                self.b1_base_fare_with_yq_aed = 1183
-            elif(self.filed_rbd == "T"):
-                self.b1_base_fare_with_yq_aed = 1378 
-            elif(self.filed_rbd == "W"):
-                self.b1_base_fare_with_yq_aed = 1638
-            elif(self.filed_rbd == "Y"):
-                self.b1_base_fare_with_yq_aed = 1963
-            elif(self.filed_rbd == "E"):
-                self.b1_base_fare_with_yq_aed = 2353
-            elif(self.filed_rbd == "I"):
-                self.b1_base_fare_with_yq_aed = 2808
-            elif(self.filed_rbd == "A"):
-                self.b1_base_fare_with_yq_aed = 3263  
-            elif(self.filed_rbd == "Y"):
-                self.b1_base_fare_with_yq_aed = 3783 
-        if(self.trip == 2):
-            if(self.filed_rbd == "L"):
-                self.b1_base_fare_with_yq_aed = 500
-            elif(self.filed_rbd == "Q"):
-                self.b1_base_fare_with_yq_aed = 600
-            elif(self.filed_rbd == "H"):
-                self.b1_base_fare_with_yq_aed = 700
-            elif(self.filed_rbd == "K"):
-                self.b1_base_fare_with_yq_aed = 820
-            elif(self.filed_rbd == "U"):
-                self.b1_base_fare_with_yq_aed = 960
-            elif(self.filed_rbd == "B"):
-                self.b1_base_fare_with_yq_aed = 1100
-            elif(self.filed_rbd == "R"):
-                self.b1_base_fare_with_yq_aed = 1280
-            elif(self.filed_rbd == "N"):
-                self.b1_base_fare_with_yq_aed = 1520
-            elif(self.filed_rbd == "M"):
-                self.b1_base_fare_with_yq_aed = 1820
-            elif(self.filed_rbd == "T"):
-                self.b1_base_fare_with_yq_aed = 2120 
-            elif(self.filed_rbd == "W"):
-                self.b1_base_fare_with_yq_aed = 2520
-            elif(self.filed_rbd == "Y"):
-                self.b1_base_fare_with_yq_aed = 3020
-            elif(self.filed_rbd == "E"):
-                self.b1_base_fare_with_yq_aed = 3620
-            elif(self.filed_rbd == "I"):
-                self.b1_base_fare_with_yq_aed = 4320
-            elif(self.filed_rbd == "A"):
-                self.b1_base_fare_with_yq_aed = 5020  
-            elif(self.filed_rbd == "Y"):
-                self.b1_base_fare_with_yq_aed = 5820
-
-        self.b1_base_fare = (self.b1_base_fare_with_yq_aed/self.exch) - self.yq_tax
-        
-        self.b1_total_fare = self.b1_base_fare + self.tax + self.yq_tax
-
-        
-        fbc = self.fbc_calc(self.origin, self.dest, self.trip, brand, channel, self.sales, self.fn, self.filed_rbd, "")
-        self.write_file(self.action, self.origin, self.dest, self.fare_class_map[self.filed_level],
-                        channel, self.trip, self.b1_baggage,
-                        brand, self.b1_base_fare, self.currency,
-                        self.b1_total_fare, fbc)
-
-    def brand2_calc(self):
-        brand = 'Brand 2'; channel = 'WEB';
-        diff = 0
-        b1_total_fare_aed = self.b1_total_fare * self.exch
-        if b1_total_fare_aed <= 500:
-            diff = 20 if self.trip == 1 else 40
-        elif b1_total_fare_aed <= 1000:
-            diff = 30 if self.trip == 1 else 60
-        elif b1_total_fare_aed <= 1500:
-            diff = 40 if self.trip == 1 else 80
-        elif b1_total_fare_aed <= 2000:
-            diff = 50 if self.trip == 1 else 100
+        reasons = np.select([mask.to_numpy(dtype=bool) for mask, _ in checks],
+                            [reason for _, reason in checks], default='')
+        df['COMPLETED'] = reasons
+        return reasons == ''
+
+
+    # Write a priced row's status, and its output rows (also to the delta workbook with
+    # in_delta), on the writer thread while there is one
+    def record(self, idx, result, in_delta=False):
+        self.df_table.at[idx, 'COMPLETED'] = result.completed
+        if self.writer is not None:
+            self.writer.put(result, in_delta)
         else:
-            diff = 80 if self.trip == 1 else 160
-        
-        diff = diff/self.exch
-        self.b2_total_fare = self.b1_total_fare + diff
-
-        self.b2_base_fare = self.b2_total_fare - self.tax - self.yq_tax
-       
-        bag_code = self.get_baggage_code(self.b2_baggage)
-        fbc = self.fbc_calc(self.origin, self.dest, self.trip, brand, channel, self.sales, self.fn, self.filed_rbd,bag_code)
-        self.write_file(self.action, self.origin, self.dest, self.fare_class_map[self.filed_level],
-                        channel, self.trip, self.b2_baggage,
-                        brand, self.b2_base_fare, self.currency,
-                        self.b2_total_fare, fbc)
-
-    def gds1_calc(self):
-        brand = 'GDS 1'; channel = 'GDS';
-        
-        # segment fee
-        b2_total_fare_aed = self.b2_total_fare * self.exch
-        if b2_total_fare_aed <= 500:
-            seg_fee = 20 if self.trip == 1 else 40
-        elif b2_total_fare_aed <= 1000:
-            seg_fee = 30 if self.trip == 1 else 60
-        elif b2_total_fare_aed <= 1500:
-            seg_fee = 40 if self.trip == 1 else 80
-        elif b2_total_fare_aed <= 2000:
-            seg_fee = 50 if self.trip == 1 else 100
-        else:
-            seg_fee = 80 if self.trip == 1 else 160
-
-        
-        self.segment_fee = seg_fee/self.exch      
-        if(self.filed_level<=5):
-            origin_count = 0 
-            dest_count = 0
-            for origin in self.df_fod['Origin']:
-                if(type(origin)==str):
-                    if(self.origin == origin.strip()):
-                        origin_count+=1
-
-            for dest in self.df_fod['Destination']:
-                if(type(dest) == str):
-                    if(self.dest == dest.strip()):
-                        dest_count+=1
-
-            if(origin_count>0 and dest_count>0):
-                self.gds1_base_fare = self.b2_base_fare + self.segment_fee - self.tfee
-            else:
-                self.gds1_base_fare = self.b2_base_fare + self.segment_fee
-
-        else:
-            self.gds1_base_fare = self.b2_base_fare + self.segment_fee
-            
-        self.gds1_total_fare = self.gds1_base_fare + self.tax + self.yq_tax + self.tfee
-
-        bag_code = self.get_baggage_code(self.gds1_baggage)
-        fbc = self.fbc_calc(self.origin, self.dest, self.trip, brand, channel, self.sales, self.fn, self.filed_rbd,bag_code)
-        self.write_file(self.action, self.origin, self.dest, self.fare_class_map[self.filed_level],
-                        channel, self.trip, self.gds1_baggage,
-                        brand, self.gds1_base_fare, self.currency,
-                        self.gds1_total_fare, fbc)
-
-    def brand3_calc(self):
-        brand = 'Brand 3'; channel = 'WEB';
-        if self.trip == 1:
-            self.b3_total_fare = self.gds1_total_fare + 100/self.exch
-        else:
-            self.b3_total_fare = self.gds1_total_fare + 200/self.exch
-
-        self.b3_base_fare = self.b3_total_fare - self.yq_tax - self.tax
-
-        bag_code = self.get_baggage_code(self.b3_baggage)
-        fbc = self.fbc_calc(self.origin, self.dest, self.trip, brand, channel, self.sales, self.fn, self.filed_rbd,bag_code)
-        self.write_file(self.action, self.origin, self.dest, self.fare_class_map[self.filed_level],
-                        channel, self.trip, self.b3_baggage,
-                        brand, self.b3_base_fare, self.currency,
-                        self.b3_total_fare, fbc)
-
-    def gds2_calc(self):
-        brand = 'GDS 2'; channel = 'GDS';
-        level = self.inv_fare_map[self.filed_rbd]
-        flex = 0.05 if 1 <= level <= 13 else 0.1
-        self.gds2_base_fare = self.b3_base_fare + (flex * (self.b3_base_fare + self.yq_tax)) + self.segment_fee
-
-        self.gds2_total_fare = self.gds2_base_fare + self.yq_tax + self.tax + self.tfee
-
-        bag_code = self.get_baggage_code(self.gds2_baggage)
-        fbc = self.fbc_calc(self.origin, self.dest, self.trip, brand, channel, self.sales, self.fn, self.filed_rbd,bag_code)
-        self.write_file(self.action, self.origin, self.dest, self.fare_class_map[self.filed_level],
-                        channel, self.trip, self.gds2_baggage,
-                        brand, self.gds2_base_fare, self.currency,
-                        self.gds2_total_fare, fbc)
-
-    def write_gh(self, df):
-        row = df.iloc[0]
-        # self.gh_ws.cell(row, 14).font = Font(color = "FF0000")
-        if(self.new_base_fare != int(self.new_base_fare)):
-            self.new_base_fare = round_nearest(self.new_base_fare)
-        out = [self.action, row['Tariff'], row['CXR'], row['NAT1'], row['NAT2'],
-                row['LOC1'], row['LOC2'], row['Rule'], row['FareClass'],
-                row['OW/RT'], row['RTG'], row['FN'], row['CUR'], self.new_base_fare,
-                row['Eff.Date'].strftime("%d/%m/%y"), row['Disc.Date'], row['GFSFAN']]
-        self.gh_ws.append(out)
-
-    def gh_lookup(self,brand):    
-        df = self.df_atpco[
-            (self.df_atpco['LOC1'] == self.translate_loc(self.origin)) &
-            (self.df_atpco['LOC2'] == self.translate_loc(self.dest)) &
-            (self.df_atpco['RBD'] == "GH") &
-            (self.df_atpco['BRAND'] == brand) &
-            (self.df_atpco['FN'] == self.fn) &
-            (self.df_atpco['OW/RT'] == self.trip)
-        ]
-       
-        return df
-
-    def gh_calc(self):
-        self.action = "Amend Fare"
-        self.channel = "TA"
-        if(self.trip == 1):
-            if(self.currency == "QAR" or self.currency == "SAR"):
-                gh_increment = 20
-            else:
-                gh_increment = 2
+            self.write(result, in_delta)
+
+    def write(self, result, in_delta=False):
+        with self.stage('write'):
+            self.output.add(result)
+            if in_delta:
+                self.delta.add(result)
+
+    # Price the rows (see price_rows) and write the output.
+    # profile_path profiles the pricing loop (see profiled).
+    def process(self, workers=1, profile_path=None):
+        with self.stage('validate'):
+            valid = self.validate()
+        # ATPCO Data is only parsed once a row is left to price
+        atpco = None
+        if valid.any():
+            atpco = self.ref.atpco
+        lookups = atpco.lookups if atpco else 0
+        with self.stage('enrich'):
+            rows = pricing_rows(self.enrich(self.df_table[valid]))
+        changed = self.changed_rows(rows) if self.state else None
+        # 'price' includes the time spent writing rows, also reported as 'write'
+        # (on the writer thread with pipeline=True)
+        with self.stage('price'), profiled(profile_path):
+            if self.pipeline:
+                self.writer = ThreadedWriter(self.write)
+            try:
+                for idx, result in price_rows(self.context, rows, workers, self.memo):
+                    self.record(idx, result, changed is not None and idx in changed)
+                if self.writer is not None:
+                    self.writer.close()
+            finally:
+                self.writer = None
+            with self.stage('write'):
+                self.output.write_gh()
+                if changed is not None:
+                    self.delta.write_gh()
+        if self.memo is not None:
+            with self.stage('memo_save'):
+                self.memo.save()
+
+        output_path = self.output_path
+        if(is_file_open(output_path)):
+            self.file_locked(output_path, "Close the output file")
+        status_writer = None
+        if self.pipeline:
+            self.close_input()
+            status_writer = ThreadedWriter(self.write_status, size=1)
+            status_writer.put()
+        with self.stage('save'):
+            self.output.save(output_path)
+        print(f"Output written to {output_path}")
+        if changed is not None:
+            delta_path = os.path.splitext(output_path)[0] + '_delta.xlsx'
+            if(is_file_open(delta_path)):
+                self.file_locked(delta_path, "Close the delta output file")
+            with self.stage('save'):
+                self.delta.save(delta_path)
+            print(f"{len(changed)} of {len(rows)} rows new or changed, written to {delta_path}")
+        if status_writer is not None:
+            status_writer.close()
         else:
-            if(self.currency == "QAR" or self.currency == "SAR"):
-                gh_increment = 40
-            else:
-                gh_increment = 4
-
-        brand = "Brand 1"
-        df = self.gh_lookup(brand)  
-        if(not df.empty):
-            self.new_base_fare = self.b1_base_fare + gh_increment
-            self.write_gh(df)
-
-        brand = "Brand 2"
-        df = self.gh_lookup(brand)  
-        if(not df.empty):
-            self.new_base_fare = self.b2_base_fare + gh_increment
-            self.write_gh(df)
-
-        brand = "Brand 3"
-        df = self.gh_lookup(brand)  
-        if(not df.empty):
-            self.new_base_fare = self.b3_base_fare + gh_increment
-            self.write_gh(df)
-            
-    def amend(self):
-        self.action = 'AMEND'
-        self.filed_rbd = self.fare_class_map[self.filed_level]
-        if(self.filed_level>8):
-            return
-        # Check current base fare in ATPCO
-        df = self.df_atpco[
-            (self.df_atpco['LOC1'] == self.translate_loc(self.origin)) &
-            (self.df_atpco['LOC2'] == self.translate_loc(self.dest)) &
-            (self.df_atpco['RBD'] == self.fare_class_map[self.filed_level]) &
-            (self.df_atpco['BRAND'] == 'Brand 1') &
-            (self.df_atpco['FN'] == self.fn) &
-            (self.df_atpco['OW/RT'] == self.trip)
-        ]
-        if not df.empty and ((df.iloc[0]['BASE FARE']) - self.b1_base_fare) == 0:
-               
-                existing_content = self.df_table.at[self.idx, 'COMPLETED']
-                new_content = str(existing_content) + '//Not amended as same fare'
-                self.df_table.at[self.idx, 'COMPLETED'] = new_content.strip()
-                return
-        if df.empty:
-            return
-        
-        self.channel = "WEB"
-        
-        fbc = self.fbc_calc(self.origin, self.dest, self.trip, "Brand 1", self.channel, self.sales, self.fn, self.filed_rbd,"")
-        self.write_file(self.action, self.origin, self.dest, self.fare_class_map[self.filed_level],
-                        self.channel, self.trip, self.b1_baggage,
-                        "Brand 1", self.b1_base_fare, self.currency,
-                        self.b1_total_fare, fbc)
-        self.b1_base_fare = self.base_fare
-        self.b1_total_fare = self.total_fare
-        self.brand2_calc()
-        self.b2_base_fare = self.base_fare
-        self.b2_total_fare = self.total_fare
-        self.gds1_calc()
-        self.gds1_base_fare = self.base_fare
-        self.gds1_total_fare = self.total_fare
-        self.brand3_calc()
-        self.b3_base_fare = self.base_fare
-        self.b3_total_fare = self.total_fare
-        self.gds2_calc()
-        self.gds2_base_fare = self.base_fare
-        self.gds2_total_fare = self.total_fare
-        self.df_table.at[self.idx, 'COMPLETED'] = 'YES'
-        self.gh_calc()              
-
-    def build(self):
-        self.action = 'NEW'
-        # use current filed_level to set RBD
-        self.filed_rbd = self.fare_class_map[self.filed_level]
-        self.brand1_calc()
-        self.brand2_calc()
-        self.gds1_calc()
-        self.brand3_calc()
-        self.gds2_calc()
-
-    def delete(self):
-        self.action = 'DEL'
-        if(self.filed_level>8):
-            return
-        for brand in ['Brand 1','Brand 2','Brand 3','GDS 1','GDS 2']:
-            self.write_del(self.origin, self.dest,
-                           self.fare_class_map[self.filed_level], brand, self.trip)
-
-    def error_check(self):
-        red_fill = PatternFill(start_color='FFC7CE', end_color='FFC7CE', fill_type='solid')
-        seen = set()
-        for row in range(2, self.file_ws.max_row + 1):
-            fbc = self.file_ws.cell(row, 17).value
-            if fbc in seen:
-                self.file_ws.cell(row, 17).fill = red_fill
-                self.file_ws.cell(row, 18, value='Not OK')
+            self.close_input()
+            self.write_status()
+        if changed is not None:
+            self.state.save(self.context)
+        if self.stats:
+            self.count_run(rows, atpco.lookups - lookups if atpco else 0)
+
+    # Add the run's lookups and outcomes to the stats. Tax and exchange rates are
+    # looked up once per priced row by enrich.
+    def count_run(self, rows, atpco_lookups):
+        self.stats.count('input_rows', len(self.df_table))
+        self.stats.count('priced_rows', len(rows))
+        self.stats.count('atpco_lookups', atpco_lookups)
+        self.stats.count('tax_lookups', len(rows))
+        self.stats.count('exchange_lookups', len(rows))
+        if self.memo is not None:
+            self.stats.count('memo_hits', self.memo.hits)
+            self.stats.count('memo_misses', self.memo.misses)
+            self.memo.hits = self.memo.misses = 0
+        self.stats.outcomes.update(self.df_table['COMPLETED'].astype(str).tolist())
+        self.stats.output_rows.update(self.output.counts)
+
+    # Ask the user to close the input workbook before its Processed sheet is replaced
+    def close_input(self):
+        if self.status.kind == 'source' and self.interactive and is_file_open(self.input_path):
+            input("Close the input file.")
+
+    # Write the table with COMPLETED back once the output is saved, or while it is saved
+    # with pipeline=True (see StatusSink)
+    def write_status(self):
+        with self.stage('status'):
+            self.status.write(self.df_table)
+
+#Price (index, PricingRow) pairs, yielding (index, RowResult) in input order.
+#Rows the memo has are not repriced; with workers > 1 the rest are priced up front in
+#worker processes (see price_parallel), otherwise one by one as they are yielded.
+def price_rows(context, rows, workers=1, memo=None):
+    cached, priced = {}, {}
+    if workers > 1:
+        todo = []
+        for idx, row in rows:
+            result = memo.get(context, row) if memo is not None else None
+            if result is None:
+                todo.append((idx, row))
             else:
-                seen.add(fbc)
-                self.file_ws.cell(row, 18, value='OK')
-
-    def process(self):
-        for self.idx, row in self.df_table.iterrows():
-            self.origin = row['O']
-            self.dest = row['D']
-            self.trip = row['O/R']
-            self.filed_rbd = row['RBD']
-            self.currency = row['CURRENCY']
-            self.b1_total_fare = row['B1']
-            
-            
-            #Check if input data is blank
-            if pd.isna(self.dest) or pd.isna(self.trip) or pd.isna(self.filed_rbd) or pd.isna(self.currency) or pd.isna(self.b1_total_fare):
-                self.df_table.at[self.idx, 'COMPLETED'] = 'Missing input data'
-                continue
-        
-            if(type(self.b1_total_fare)!=int and type(self.b1_total_fare)!= float):
-                self.df_table.at[self.idx, 'COMPLETED'] = 'Incorrect B1 fare in input sheet'
+                cached[idx] = result
+        if len(todo) > 1:
+            priced = dict(price_parallel(context, todo, workers))
+    for idx, row in rows:
+        if idx in cached:
+            yield idx, cached[idx]
+            continue
+        result = priced.get(idx)
+        if result is None and memo is not None and workers <= 1:
+            result = memo.get(context, row)
+            if result is not None:
+                yield idx, result
                 continue
-
-            final_total_fare = self.b1_total_fare
-
-            #Check if origin and destination is in the restricted list
-
-            res_origin_count = 0 
-            res_dest_count = 0
-
-            for res_origin in self.df_restricted_od['Origin']:
-                if(self.origin == res_origin.strip()):
-                    res_origin_count+=1
-            
-            for res_dest in self.df_restricted_od['Destination']:
-                if(self.dest == res_dest.strip()):
-                    res_dest_count+=1
-
-            if(res_origin_count>0 and res_dest_count>0):
-                self.df_table.at[self.idx, 'COMPLETED'] = 'Restricted OD'
-                continue            
-            
-            #Check if correct origin is in the input sheet
-            origin_count = 0
-            for origin_cell_value in self.df_fod["Origin"]:
-                if(type(origin_cell_value) == str):
-                    if(self.origin == origin_cell_value.strip() or self.origin == "SLL"):
-                        origin_count+=1
-            
-            if(origin_count<=0):
-                self.df_table.at[self.idx, 'COMPLETED'] = 'Incorrect origin in input sheet'
-                continue
-            
-            #Check if correct destination is in the input sheet
-            dest_count = 0
-            for dest_cell_value in self.df_fod["All Destination"]:
-                if(type(dest_cell_value) == str):
-                    if(self.dest == dest_cell_value.strip()):
-                        dest_count+=1
-            
-            if(dest_count<=0):
-                self.df_table.at[self.idx, 'COMPLETED'] = 'Incorrect destination in input sheet'
-                continue
-
-            #Check if incorrect trip type is in the input sheet
-            if(self.trip!=1 and self.trip!=2):
-                self.df_table.at[self.idx, 'COMPLETED'] = 'Incorrect trip type in input sheet'
-                continue
-            
-            if(type(self.filed_rbd) == str):
-                if(len(self.filed_rbd)!=1):
-                    self.df_table.at[self.idx, 'COMPLETED'] = 'Incorrect RBD in input sheet'
-                    continue
-            else:
-                self.df_table.at[self.idx, 'COMPLETED'] = 'Incorrect RBD in input sheet'  
-                continue
-
-            #Check if incorrect currency is in the input sheet
-            if(self.currency!="BHD" and self.currency!="KWD" and self.currency!="QAR" and self.currency!="SAR" and self.currency!="OMR"):
-                self.df_table.at[self.idx, 'COMPLETED'] = 'Incorrect currency in input sheet'
-                continue
-
-            self.filed_level = self.inv_fare_map[self.filed_rbd]
-            # Calculate Baggage
-            if(self.filed_level>8):
-                self.b2_baggage = self.baggage_structure(self.origin, self.dest, self.filed_rbd, 'Brand 2',self.trip)
-                self.b3_baggage = self.baggage_structure(self.origin, self.dest, self.filed_rbd, 'Brand 3',self.trip)
-                self.gds1_baggage = self.baggage_structure(self.origin, self.dest, self.filed_rbd, 'GDS 1',self.trip)
-                self.gds2_baggage = self.baggage_structure(self.origin, self.dest, self.filed_rbd, 'GDS 2',self.trip)
-                self.b1_baggage = self.baggage_structure(self.origin, self.dest, self.filed_rbd, 'Brand 1',self.trip)
-            else:
-                self.b2_baggage = self.baggage_non_structure(self.origin, self.dest, self.filed_rbd, 'Brand 2', self.fn, self.trip)
-                self.b3_baggage = self.baggage_non_structure(self.origin, self.dest, self.filed_rbd, 'Brand 3', self.fn, self.trip)
-                self.gds1_baggage = self.baggage_non_structure(self.origin, self.dest, self.filed_rbd, 'GDS 1', self.fn, self.trip)
-                self.gds2_baggage = self.baggage_non_structure(self.origin, self.dest, self.filed_rbd, 'GDS 2', self.fn, self.trip)
-                self.b1_baggage = self.baggage_non_structure(self.origin, self.dest, self.filed_rbd, 'Brand 1', self.fn, self.trip)
-
-            # Check if baggage data is available in the ATPCO
-            if(self.b1_baggage==0 or self.b2_baggage==0 or self.b3_baggage==0 or self.gds1_baggage==0 or self.gds2_baggage==0):
-                self.df_table.at[self.idx, 'COMPLETED'] = 'Missing ATPCO data'
-                continue
-                            
-            # Calcualte taxes & fees
-            if(self.trip == 1):
-                self.trip_tax = "OW"
-            elif (self.trip == 2):
-                self.trip_tax = "RT"
-
-            tax_data = self.df_tax[(self.df_tax['Origin'].str.strip()==self.origin) &
-                               (self.df_tax['Destination'].str.strip()==self.dest) &
-                               (self.df_tax['JourneyType'].str.strip()==self.trip_tax)].iloc[0]
-            self.tax = tax_data['FixedTaxTotal']
-            self.yq_tax = tax_data['YQ']
-            self.tfee = tax_data['YR']
-
-            #Check if data in tax sheet is blank // if not round to the nearest integer
-            if pd.isna(self.tax) or pd.isna(self.yq_tax) or pd.isna(self.tfee):
-                self.df_table.at[self.idx, 'COMPLETED'] = 'Missing Tax data'
-                continue
-
-            #Calculate base fare with yq in AED to get the fare level
-            self.b1_base_fare = self.b1_total_fare - self.tax - self.yq_tax
-            final_base_fare = self.b1_base_fare
-            self.b1_base_fare_with_yq = self.b1_total_fare - self.tax
-            self.exch = self.get_exchange_rate(self.currency)
-            self.b1_base_fare_with_yq_aed = self.b1_base_fare_with_yq * self.exch
-            self.b1_base_fare_with_yq_aed = self.b1_base_fare_with_yq_aed.astype(int)
-            
-            if(self.trip == 1):
-                if(self.b1_base_fare_with_yq_aed<50):
-                    self.df_table.at[self.idx, 'COMPLETED'] = 'Incorrect B1 total fare'
-                    continue
-            if(self.trip ==2):
-                if(self.b1_base_fare_with_yq_aed<50):
-                    self.df_table.at[self.idx, 'COMPLETED'] = 'Incorrect B1 total fare'
-                    continue
-
-            # Determine new RBD and levels
-            self.new_rbd = self.get_new_rbd(self.b1_base_fare_with_yq_aed, self.trip)
-            self.new_level = self.inv_fare_map[self.new_rbd]
-            #Calculate tfee discount
-            od = self.origin + self.dest
-            if(self.filed_level <=5):
-                filtered_tfee_row = self.df_tfee_discount[(self.df_tfee_discount['Ods'].str.strip()==od)]
-                if not filtered_tfee_row.empty:
-                    tfee_row = filtered_tfee_row.iloc[0]
-                    if(self.trip == 1):
-                        self.tfee = tfee_row["OW"]
-            
-                    if(self.trip == 2):
-                        self.tfee = tfee_row["RT"]
-                #Check if tfee discount row is empty // else round to the nearest integer
-                if pd.isna(self.tfee):
-                    self.df_table.at[self.idx, 'COMPLETED'] = 'Missing TFEE data in Fare Calc OD sheet'
-                    continue
-
-            if(self.filed_level > 9):
-                self.filed_level = 9
-
-            self.brand = "Brand 1"
-            
-            if (self.filed_level == self.new_level):
-                self.amend()
-            elif (self.filed_level > self.new_level):
-                while (self.filed_level - self.new_level) > 0:
-                    self.filed_level -= 1
-                    if(self.filed_level - self.new_level == 0):
-                        self.channel = "WEB"
-                        self.action = "NEW"
-                        self.b1_total_fare = final_total_fare
-                        self.b1_base_fare = final_base_fare
-                        self.filed_rbd = self.fare_class_map[self.filed_level]
-                        fbc = self.fbc_calc(self.origin, self.dest, self.trip, "Brand 1", self.channel, self.sales, self.fn, self.filed_rbd,"")
-                        self.write_file(self.action, self.origin, self.dest, self.fare_class_map[self.filed_level],
-                        self.channel, self.trip, self.b1_baggage,
-                        "Brand 1", self.b1_base_fare, self.currency,
-                        self.b1_total_fare, fbc)
-                        self.brand2_calc()
-                        self.gds1_calc()
-                        self.brand3_calc()
-                        self.gds2_calc()
-                    else:
-                        self.build()
-                
-                self.gh_calc()
-                existing_content = self.df_table.at[self.idx, 'COMPLETED']
-                new_content = str(existing_content) + ' YES'
-                self.df_table.at[self.idx, 'COMPLETED'] = new_content.strip()
-            else:
-                while (self.filed_level <= self.new_level):
-                    if (self.filed_level == self.new_level):
-                        df = self.df_atpco[
-                            (self.df_atpco['LOC1'].str.strip() == self.translate_loc(self.origin)) &
-                            (self.df_atpco['LOC2'].str.strip() == self.translate_loc(self.dest)) &
-                            (self.df_atpco['RBD'].str.strip() == self.fare_class_map[self.filed_level]) &
-                            (self.df_atpco['BRAND'].str.strip() == 'Brand 1') &
-                            (self.df_atpco['FN'].str.strip() == self.fn) &
-                            (self.df_atpco['OW/RT'] == self.trip)
-                        ]              
-                        if not df.empty and -1 <= (df.iloc[0]['BASE FARE'] - final_base_fare) <= 1:
-                            if(self.currency == "SAR" or self.currency == "QAR"):
-                                final_base_fare+=10
-                                final_total_fare+=10
-                            else:
-                                final_base_fare+=1
-                                final_total_fare+=1
-
-                            
-                            self.b1_total_fare = final_total_fare
-                            self.b1_base_fare = final_base_fare
-                            existing_content = self.df_table.at[self.idx, 'COMPLETED']
-                            new_content = str(existing_content) + ' YES'
-                            self.df_table.at[self.idx, 'COMPLETED'] = new_content.strip()
-                            self.amend()
-                              
-                        else:
-                            existing_content = self.df_table.at[self.idx, 'COMPLETED']
-                            new_content = str(existing_content) + ' YES'
-                            self.df_table.at[self.idx, 'COMPLETED'] = new_content.strip()
-                            self.amend()                                                       
-                    else:
-                        self.delete()
-                    self.filed_level+=1
-            if(self.filed_level>8 or self.new_level>8):
-                existing_content = self.df_table.at[self.idx, 'COMPLETED']
-                new_content = str(existing_content) + '//Structure RBD'
-                self.df_table.at[self.idx, 'COMPLETED'] = new_content.strip()
-        path = resolve_path_input('input.xlsx')
-        with pd.ExcelWriter(path,
-                            engine='openpyxl',
-                            mode='a',
-                            if_sheet_exists='replace') as writer:
-                                # overwrite the “Processed” sheet if it already exists
-                                self.df_table.to_excel(writer, sheet_name='Processed', index=False)
-
-        #Final duplicate check and save
-        self.error_check()
-        output_path = resolve_path_output('output.xlsx')
-        if(is_file_open(output_path)):
-            input("Close the output file")
+        if result is None:
+            result = price_row(context, row)
+        if memo is not None:
+            memo.put(context, row, result)
+        yield idx, result
+
+#Short stable name for a context key (see PricingContext.key)
+def context_id(context_key):
+    return hashlib.sha1(repr(context_key).encode()).hexdigest()
+
+#Results of price_row kept by context key (see PricingContext.key) and row inputs (see row_key),
+#so rows repeated within a run, across a batch or across reruns are priced once.
+#The most recently used size results are kept in memory. With a path, results are also
+#stored in that folder, one pickle per context key, and reused by later runs of the same
+#data.xlsx, input header and filing date; a folder that can't be written just means no store.
+#Only the store of the context last used is held in memory, with its most recently used
+#size results.
+class PriceMemo:
+    def __init__(self, size=100000, path=None):
+        self.size = size
+        self.path = path
+        self.recent = OrderedDict()
+        self.stores = {}
+        self.changed = set()
+        self.hits = 0
+        self.misses = 0
+
+    def store_path(self, context_key):
+        return os.path.join(self.path, context_id(context_key) + '.pkl')
+
+    # Stored results for a context key, read from disk on first use. The store held
+    # for another context is written out first and dropped.
+    def store(self, context_key):
+        if context_key not in self.stores:
+            if self.stores:
+                self.save()
+                self.stores.clear()
+            entries = {}
+            try:
+                with open(self.store_path(context_key), 'rb') as f:
+                    entries = pickle.load(f)
+            except (OSError, EOFError, pickle.UnpicklingError):
+                pass
+            self.stores[context_key] = OrderedDict(entries)
+        return self.stores[context_key]
+
+    def remember(self, key, result):
+        self.recent[key] = result
+        self.recent.move_to_end(key)
+        if len(self.recent) > self.size:
+            self.recent.popitem(last=False)
+
+    # Memoised RowResult for the row, or None
+    def get(self, context, row):
+        key = (context.key(), row_key(row))
+        result = self.recent.get(key)
+        if result is not None:
+            self.recent.move_to_end(key)
+        elif self.path:
+            entries = self.store(key[0])
+            result = entries.get(key[1])
+            if result is not None:
+                entries.move_to_end(key[1])
+                self.remember(key, result)
+        if result is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return result
+
+    def put(self, context, row, result):
+        key = (context.key(), row_key(row))
+        self.remember(key, result)
+        if self.path:
+            entries = self.store(key[0])
+            entries[key[1]] = result
+            entries.move_to_end(key[1])
+            if len(entries) > self.size:
+                entries.popitem(last=False)
+            self.changed.add(key[0])
+
+    # Write the stores that gained results since the last save
+    def save(self):
+        if not self.path:
             return
-        self.out_wb.save(output_path)
-        print(f"Output written to {output_path}")
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            for context_key in self.changed:
+                path = self.store_path(context_key)
+                with open(path + '.tmp', 'wb') as f:
+                    pickle.dump(self.stores[context_key], f, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(path + '.tmp', path)
+        except OSError:
+            pass
+        self.changed.clear()
+
+#Split (index, PricingRow) pairs into shards of whole OD groups, balanced by row count
+#(largest groups placed first)
+def shard_by_od(rows, shards):
+    groups = {}
+    for idx, row in rows:
+        groups.setdefault((row.origin, row.dest), []).append((idx, row))
+    sizes = [(0, i) for i in range(shards)]
+    buckets = [[] for _ in range(shards)]
+    for group in sorted(groups.values(), key=len, reverse=True):
+        size, i = heapq.heappop(sizes)
+        buckets[i].extend(group)
+        heapq.heappush(sizes, (size + len(group), i))
+    return [bucket for bucket in buckets if bucket]
+
+# Price rows in a pool of worker processes. Workers get the context once (inherited through
+# fork where the platform has it, pickled once per worker otherwise) and each prices shards
+# of whole ODs. Returns (index, RowResult) pairs in input order, as a serial run gives them.
+def price_parallel(context, rows, workers):
+    context.ref.load()
+    mp_context = mp.get_context('fork') if 'fork' in mp.get_all_start_methods() else None
+    results = {}
+    with ProcessPoolExecutor(workers, mp_context=mp_context, initializer=_init_worker,
+                             initargs=(context,)) as pool:
+        for shard_results, lookups in pool.map(_price_shard, shard_by_od(rows, workers * 4)):
+            results.update(shard_results)
+            context.ref.atpco.lookups += lookups
+    return [(idx, results[idx]) for idx, _ in rows]
+
+# Pricing context of a parallel worker process, set up once by _init_worker
+_worker_context = None
+
+def _init_worker(context):
+    global _worker_context
+    _worker_context = context
+
+# Results of a shard, and the ATPCO lookups pricing it took
+def _price_shard(rows):
+    atpco = _worker_context.ref.atpco
+    lookups = atpco.lookups
+    results = [(idx, price_row(_worker_context, row)) for idx, row in rows]
+    return results, atpco.lookups - lookups
+
+# Exit codes for scheduled runs
+EXIT_OK = 0
+EXIT_FAILED = 1
+EXIT_LOCKED = 3
+EXIT_NO_INPUT = 4
+
+#Input workbooks named on the command line: files, directories (every .xlsx in them) or glob patterns
+def expand_inputs(patterns):
+    paths = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            matches = sorted(glob.glob(os.path.join(pattern, '*.xlsx')))
+        elif glob.has_magic(pattern):
+            matches = sorted(glob.glob(pattern))
+        else:
+            matches = [pattern]
+        # Skip Excel's lock files (~$input.xlsx)
+        paths.extend(os.path.abspath(p) for p in matches if not os.path.basename(p).startswith('~$'))
+    return paths
+
+#Output workbook for an input: the --output file for a single input, otherwise
+#<input name>_output.xlsx in the --output directory (also for an --output ending in a
+#separator, which names a directory that may not exist yet)
+def output_path_for(input_path, output, batch):
+    if output is None:
+        return resolve_path_output('output.xlsx') if not batch else resolve_path_output(
+            os.path.splitext(os.path.basename(input_path))[0] + '_output.xlsx')
+    if batch or os.path.isdir(output) or output.endswith(('/', os.sep)):
+        return os.path.join(output, os.path.splitext(os.path.basename(input_path))[0] + '_output.xlsx')
+    return os.path.abspath(output)
+
+#--profile file for an input: one per input workbook in a batch
+def profile_path_for(profile, input_path, batch):
+    if not profile or not batch:
+        return profile
+    base, ext = os.path.splitext(profile)
+    return f"{base}_{os.path.splitext(os.path.basename(input_path))[0]}{ext}"
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="File fares from an input workbook against data.xlsx.")
+    parser.add_argument('-i', '--input', action='append', default=[],
+                        help="input workbook, directory of workbooks or glob pattern; repeat for a batch "
+                             "(default: source/input.xlsx)")
+    parser.add_argument('-d', '--data', help="reference workbook (default: source/data.xlsx)")
+    parser.add_argument('-o', '--output',
+                        help="output workbook, or a directory for batches (default: output/output.xlsx)")
+    parser.add_argument('--non-interactive', action='store_true',
+                        help="never wait for Enter; report locked files through the exit code")
+    parser.add_argument('--write-only', action='store_true',
+                        help="stream the output workbook to disk as rows are produced")
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help="price rows in this many processes (0: one per CPU)")
+    parser.add_argument('--no-cache', action='store_true', help="always reparse data.xlsx")
+    parser.add_argument('--cache-hash', action='store_true',
+                        help="also compare data.xlsx contents before reusing the cache")
+    parser.add_argument('--memo', action='store_true',
+                        help="price repeated rows once per run or batch")
+    parser.add_argument('--memo-dir',
+                        help="also keep priced rows in this folder and reuse them in later runs "
+                             "(same data.xlsx, input header and day)")
+    parser.add_argument('--incremental', action='store_true',
+                        help="reprice only rows new or changed since the last run, and also write "
+                             "them to <output>_delta.xlsx")
+    parser.add_argument('--status', choices=['source', 'csv', 'xlsx', 'parquet', 'none'], default='source',
+                        help="write the COMPLETED column back to the input workbook (source), to "
+                             "<input>_processed.<ext> next to the output, or nowhere")
+    parser.add_argument('--pipeline', action='store_true',
+                        help="overlap reading, pricing, writing and saving on threads")
+    parser.add_argument('--check-atpco', action='store_true',
+                        help="also flag NEW FILE rows whose FBC is already filed in ATPCO Data")
+    parser.add_argument('--stats', metavar='PATH',
+                        help="write stage timings, lookup and outcome counts and peak memory to this JSON file")
+    parser.add_argument('--trace-memory', action='store_true',
+                        help="with --stats, also trace the peak of Python allocations (much slower)")
+    parser.add_argument('--profile', metavar='PATH',
+                        help="profile the pricing loop into this file: cProfile stats, or a "
+                             "pyinstrument report for .html paths when it is installed")
+    parser.add_argument('--engine', choices=['openpyxl', 'calamine', 'auto'], default='openpyxl',
+                        help="Excel reader (calamine needs python-calamine)")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    interactive = not args.non_interactive
+    print("Filing script is running...")
+    inputs = expand_inputs(args.input) if args.input else [resolve_path_input('input.xlsx')]
+    if not inputs:
+        print("No input workbooks found")
+        return EXIT_NO_INPUT
+    batch = len(inputs) > 1
+    workers = args.workers or os.cpu_count() or 1
+    cache = False if args.no_cache else ('hash' if args.cache_hash else True)
+    data_path = os.path.abspath(args.data) if args.data else resolve_path_input('data.xlsx')
+    stats = RunStats(trace_memory=args.trace_memory) if args.stats else None
+    with stats.stage('read_data') if stats else nullcontext():
+        reference = ReferenceData(data_path, cache=cache, engine=args.engine, stats=stats)
+    if args.pipeline:
+        reference.preload()
+    memo = PriceMemo(path=args.memo_dir) if args.memo or args.memo_dir else None
+    status = EXIT_OK
+    for input_path in inputs:
+        if batch:
+            print(f"Processing {input_path}")
+        try:
+            processor = FareFilingProcessor(input_path, reference=reference, engine=args.engine,
+                                            output_path=output_path_for(input_path, args.output, batch),
+                                            write_only=args.write_only, interactive=interactive,
+                                            memo=memo, incremental=args.incremental,
+                                            status=args.status, stats=stats,
+                                            check_atpco=args.check_atpco, pipeline=args.pipeline)
+            processor.process(workers=workers, profile_path=profile_path_for(args.profile, input_path, batch))
+        except FileLockedError as e:
+            print(f"Locked, skipped: {e}")
+            status = max(status, EXIT_LOCKED)
+        except Exception:
+            if not batch:
+                raise
+            traceback.print_exc()
+            status = max(status, EXIT_FAILED)
+    if stats:
+        stats.write(args.stats)
+        print(f"Run stats written to {args.stats}")
+    if interactive:
         input("\nPress Enter to exit...")
-
+    return status
 
 if __name__ == '__main__':
-    print("Filing script is running...")
-    processor = FareFilingProcessor('input.xlsx', 'data.xlsx')
-    processor.process()
+    mp.freeze_support()
+    sys.exit(main())
@@ -0,0 +1,164 @@
+import os
+import sys
+import shutil
+import argparse
+import tempfile
+import subprocess
+from openpyxl import load_workbook
+import benchmark
+
+# Golden-output check for fare_filing_script: files the same synthetic workbooks with a
+# reference implementation and with each run mode of the current script, and diffs the
+# DELETE, FILE and GH FARE AMENDMENT sheets (values and fills) and the Processed sheet
+# cell by cell. The generated workbooks include fixed rows for the pricing edge cases
+# (see benchmark.EDGE_CASES).
+#
+#   python golden.py                          # every mode against a plain serial run
+#   python golden.py --against fba1a85        # ... against the script at a git revision
+#   python golden.py --against old_script.py --modes parallel memo
+#
+# The reference is run the way the script has always been run (source/ and output/
+# folders next to it, Enter at the prompts), so any past version can be the reference.
+# Exits with 1 when any mode differs.
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fare_filing_script.py')
+
+# Run modes of the current script: command line options and how many times it is run.
+# Repeated runs check the output of the last one (cached or incremental results).
+MODES = {
+    'serial': ([], 1),
+    'write-only': (['--write-only'], 1),
+    'parallel': (['--workers', '3'], 1),
+    'memo': (['--memo'], 1),
+    'memo-disk': (['--memo-dir', '{dir}/memo'], 2),
+    'incremental': (['--incremental'], 2),
+    'cached-data': ([], 2),
+    'status-xlsx': (['--status', 'xlsx'], 1),
+    'pipeline': (['--pipeline', '--workers', '2'], 1),
+}
+
+#Copy the workbooks into a fresh run folder laid out as the script expects
+def prepare(folder, data_path, input_path):
+    shutil.rmtree(folder, ignore_errors=True)
+    os.makedirs(os.path.join(folder, 'source'))
+    os.makedirs(os.path.join(folder, 'output'))
+    shutil.copy(data_path, os.path.join(folder, 'source', 'data.xlsx'))
+    shutil.copy(input_path, os.path.join(folder, 'source', 'input.xlsx'))
+
+def run(command, folder):
+    done = subprocess.run(command, cwd=folder, input='\n' * 5, capture_output=True, text=True)
+    if done.returncode != 0:
+        raise RuntimeError(f"{' '.join(command)} failed in {folder}:\n{done.stdout}{done.stderr}")
+
+#Script file for --against: a path, or a git revision of fare_filing_script.py
+def reference_script(against, folder):
+    target = os.path.join(folder, 'fare_filing_script.py')
+    if os.path.isfile(against):
+        shutil.copy(against, target)
+    else:
+        source = subprocess.run(['git', 'show', f'{against}:fare_filing_script.py'], capture_output=True,
+                                cwd=os.path.dirname(SCRIPT), check=True).stdout
+        with open(target, 'wb') as f:
+            f.write(source)
+
+#Run the reference implementation; returns its (output workbook, Processed workbook)
+def run_reference(against, folder, data_path, input_path):
+    prepare(folder, data_path, input_path)
+    reference_script(against, folder)
+    run([sys.executable, 'fare_filing_script.py'], folder)
+    return os.path.join(folder, 'output', 'output.xlsx'), os.path.join(folder, 'source', 'input.xlsx')
+
+#Run the current script in a mode; returns its (output workbook, Processed workbook)
+def run_mode(mode, folder, data_path, input_path):
+    options, runs = MODES[mode]
+    prepare(folder, data_path, input_path)
+    source = os.path.join(folder, 'source')
+    output = os.path.join(folder, 'output', 'output.xlsx')
+    command = [sys.executable, SCRIPT, '--non-interactive', '-i', os.path.join(source, 'input.xlsx'),
+               '-d', os.path.join(source, 'data.xlsx'), '-o', output]
+    command += [option.format(dir=folder) for option in options]
+    for _ in range(runs):
+        run(command, folder)
+    if '--status' in options:
+        return output, os.path.join(folder, 'output', 'input_processed.xlsx')
+    return output, os.path.join(source, 'input.xlsx')
+
+#Cell values and fills of a sheet, row by row
+def sheet_cells(ws):
+    return [[(cell.value, cell.fill.fgColor.rgb if cell.fill.fill_type else None) for cell in row]
+            for row in ws.iter_rows()]
+
+def workbook_cells(output_path, processed_path):
+    wb = load_workbook(output_path)
+    sheets = {ws.title: sheet_cells(ws) for ws in wb.worksheets}
+    processed = load_workbook(processed_path)
+    if 'Processed' in processed.sheetnames:
+        sheets['Processed'] = sheet_cells(processed['Processed'])
+    return sheets
+
+#Cell by cell differences between two runs, as 'SHEET!A1: expected != actual' lines
+def diff(expected, actual, limit=10):
+    lines = []
+    for name in ['DELETE', 'FILE', 'GH FARE AMENDMENT', 'Processed']:
+        a, b = expected.get(name), actual.get(name)
+        if a is None or b is None:
+            if a is not b:
+                lines.append(f"{name}: sheet missing from {'reference' if a is None else 'run'}")
+            continue
+        if len(a) != len(b):
+            lines.append(f"{name}: {len(a)} rows != {len(b)} rows")
+        found = 0
+        for r, (row_a, row_b) in enumerate(zip(a, b), start=1):
+            for c in range(max(len(row_a), len(row_b))):
+                cell_a = row_a[c] if c < len(row_a) else (None, None)
+                cell_b = row_b[c] if c < len(row_b) else (None, None)
+                if cell_a != cell_b:
+                    found += 1
+                    if found <= limit:
+                        column = chr(ord('A') + c) if c < 26 else f'col{c + 1}'
+                        lines.append(f"{name}!{column}{r}: {cell_a!r} != {cell_b!r}")
+        if found > limit:
+            lines.append(f"{name}: {found - limit} more differing cells")
+    return lines
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Diff fare_filing_script run modes against a reference run.")
+    parser.add_argument('--against', help="reference script: a file or git revision "
+                                          "(default: the current script's serial run)")
+    parser.add_argument('--modes', nargs='+', choices=list(MODES), default=list(MODES))
+    parser.add_argument('--atpco', type=int, default=10000, help="ATPCO rows of the generated data.xlsx")
+    parser.add_argument('--rows', type=int, default=500, help="rows of the generated input.xlsx")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--data', help="use this data.xlsx instead of generating one")
+    parser.add_argument('--input', help="use this input.xlsx instead of generating one")
+    parser.add_argument('--workdir', help="keep the run folders here (default: a temp folder)")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    if bool(args.data) != bool(args.input):
+        sys.exit("--data and --input go together")
+    workdir = args.workdir or tempfile.mkdtemp(prefix='filing_golden_')
+    os.makedirs(workdir, exist_ok=True)
+    data_path = args.data or os.path.join(workdir, 'data.xlsx')
+    input_path = args.input or os.path.join(workdir, 'input.xlsx')
+    if not args.data:
+        ods, taxes = benchmark.make_data(data_path, args.atpco, seed=args.seed)
+        benchmark.make_input(input_path, args.rows, ods, taxes, seed=args.seed)
+
+    folder = os.path.join(workdir, 'reference')
+    if args.against:
+        expected = workbook_cells(*run_reference(args.against, folder, data_path, input_path))
+    else:
+        expected = workbook_cells(*run_mode('serial', folder, data_path, input_path))
+    status = 0
+    for mode in args.modes:
+        lines = diff(expected, workbook_cells(*run_mode(mode, os.path.join(workdir, mode), data_path, input_path)))
+        print(f"{mode}: {'identical' if not lines else 'DIFFERENT'}")
+        for line in lines:
+            print(f"  {line}")
+        status = status or (1 if lines else 0)
+    return status
+
+if __name__ == '__main__':
+    sys.exit(main())